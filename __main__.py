@@ -1,13 +1,21 @@
 
 import argparse
 import asyncio
+import multiprocessing
+import os
 import re
 import signal
 import sys
 
+from contextlib import suppress
+from pathlib import Path
+
 from .dbus.org_freedesktop_DBus import DBus
 from .dbus.signals import NameOwnerChanged
 
+from .server import metrics
+from .server.coordinator import Coordinator, runWorker
+from .server.prefetch import AudioCache, Prefetcher
 from .server.server import Server
 from .server.tracklist import Queue
 
@@ -16,7 +24,53 @@ from jeepney.io.asyncio import  open_dbus_router
 from jeepney.io.asyncio import Proxy
 
 
-async def main(address, port, bus_name):
+async def serveWithWorkers(address, port, tracklist, workers, stopRequested, **options):
+    """
+    Serves HTTP from several worker processes sharing the port. This process
+    only owns the tracklist and the connection with the media player.
+    """
+    path = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), f"jukebox-{os.getpid()}.sock")
+    coordinator = Coordinator(tracklist, path)
+    # Workers serve the metrics of all processes, told apart by this label
+    metrics.registry.constantLabels = [("process", "coordinator")]
+    metrics.queueLength.setFunction(lambda: len(tracklist.tracklist))
+
+    # Prefetching replaces track uris in the player, so it must run here
+    prefetcher = None
+    prefetch = options.pop("prefetch", 0)
+    prefetchSize = options.pop("prefetchSize", 512)
+    if prefetch > 0 and options.get("cacheDir") is not None:
+        audio = AudioCache(Path(options["cacheDir"]) / "audio", prefetchSize * 2**20)
+        prefetcher = Prefetcher(tracklist, audio, prefetch)
+
+    # Workers may start a search process pool, which daemonic processes can't.
+    # They are terminated below, and exit by themselves if this process dies.
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=runWorker, args=(index, path, address, port, options))
+                 for index in range(workers)]
+    try:
+        await coordinator.start()
+        if prefetcher is not None:
+            prefetcher.start()
+        for process in processes:
+            process.start()
+        print(f"Running with {workers} HTTP workers. Press Ctrl-C to exit.")
+        await stopRequested
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        loop = asyncio.get_running_loop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        if prefetcher is not None:
+            await prefetcher.stop()
+        await coordinator.stop()
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+
+
+async def main(address, port, bus_name, httpWorkers=0, **options):
     loop = asyncio.get_event_loop()
 
     # Create a future that is done when the user requests the service's termination
@@ -64,9 +118,13 @@ async def main(address, port, bus_name):
                 if changed.done():
                     vlcInstances = [changed.result()]
 
-        if vlcInstances:
+        if vlcInstances and httpWorkers > 0:
+            tracklist = Queue(dbusRouter, vlcInstances[0])
+            await tracklist.handlers # wait dbus signal subscription is completed
+            await serveWithWorkers(address, port, tracklist, httpWorkers, stopRequested, **options)
+        elif vlcInstances:
             tracklist = Queue(dbusRouter, vlcInstances[0])
-            server = Server(address, port, tracklist)
+            server = Server(address, port, tracklist, **options)
             try:
                 await tracklist.handlers # wait dbus signal subscription is completed
                 await server.start()
@@ -82,6 +140,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="jukebox", description="Stream music from a web media service on demand")
     parser.add_argument("http_server_address", nargs="?", help="address and port pair to listen for HTTP connections (default: 'localhost:8080')", default="localhost:8080")
     parser.add_argument("-b", "--bus_name", help="media player bus name (default: any)", default=None)
+    parser.add_argument("-s", "--search_mode", choices=["thread", "process"], help="run searches in a thread pool or in a process pool (default: 'thread')", default="thread")
+    parser.add_argument("-w", "--search_workers", type=int, help="number of search workers (default: number of cores in process mode)", default=None)
+    parser.add_argument("-c", "--cache_dir", help="directory where resolved songs are remembered across restarts (default: '$XDG_CACHE_HOME/jukebox')",
+                        default=os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "jukebox"))
+    parser.add_argument("-r", "--rate_limit", type=float, help="searches per minute allowed for each client (default: 10)", default=10)
+    parser.add_argument("-p", "--max_pending", type=int, help="maximum number of searches waiting or in progress (default: twice the search workers)", default=None)
+    parser.add_argument("-n", "--prefetch", type=int, help="number of upcoming tracks to download ahead of time into the cache directory (default: 0, disabled)", default=0)
+    parser.add_argument("--prefetch_size", type=int, help="maximum size of downloaded tracks in MiB (default: 512)", default=512)
+    parser.add_argument("-j", "--http_workers", type=int, help="serve HTTP from this many processes sharing the port, while this one talks to the media player (default: 0, serve from this process)", default=0)
+    parser.add_argument("-d", "--develop", action="store_true", help="reload the page template when it is modified")
 
     args = parser.parse_args()
 
@@ -94,4 +162,13 @@ if __name__ == "__main__":
     host = http_addr.group(1)
     port = int(http_addr.group(2))
     print(f"Listening at: http://{host}:{port}")
-    asyncio.run(main(host, port, args.bus_name))
+    asyncio.run(main(host, port, args.bus_name,
+                     searchMode=args.search_mode,
+                     searchWorkers=args.search_workers,
+                     cacheDir=args.cache_dir,
+                     rateLimit=args.rate_limit,
+                     maxPending=args.max_pending,
+                     prefetch=args.prefetch,
+                     prefetchSize=args.prefetch_size,
+                     develop=args.develop,
+                     httpWorkers=args.http_workers))
@@ -0,0 +1,174 @@
+# Load test of the HTTP server against a fake search engine and media player.
+# The server runs in a child process, so that load generation does not share
+# its event loop nor its CPU time.
+import aiohttp
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import time
+
+from collections import Counter, defaultdict
+
+from jukebox.bench.fakes import runServer
+
+
+def residentSize(pid):
+    "Resident set size of a process, in KiB"
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+class Results:
+    def __init__(self):
+        # Latencies by request kind, in seconds
+        self.latencies = defaultdict(list)
+        # Response status counts by request kind
+        self.statuses = defaultdict(Counter)
+        # Change events received by all subscribers
+        self.events = 0
+        self.errors = Counter()
+
+    async def timed(self, kind, session, method, url, **kwargs):
+        start = time.monotonic()
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                await response.read()
+                self.statuses[kind][response.status] += 1
+                if response.status < 400:
+                    self.latencies[kind].append(time.monotonic() - start)
+                return response
+        except aiohttp.ClientError as error:
+            self.errors[type(error).__name__] += 1
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def subscriber(base, results):
+    "Keeps a /changes stream open, counting the events received"
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base}/changes") as response:
+            async for line in response.content:
+                if line.startswith(b"data:"):
+                    results.events += 1
+
+
+async def poster(base, rate, distinct, results):
+    "Submits 'rate' queries per second. Queries repeat every 'distinct', so that some hit the cache."
+    async with aiohttp.ClientSession() as session:
+        requests = set()
+        try:
+            for i in range(2**63):
+                request = asyncio.create_task(results.timed("POST /tracks", session, "POST", f"{base}/tracks",
+                                                            data=f"bench query {i % distinct}"))
+                requests.add(request)
+                request.add_done_callback(requests.discard)
+                await asyncio.sleep(1 / rate)
+        finally:
+            # Requests still in progress when the load stops are not accounted
+            for request in requests:
+                request.cancel()
+            await asyncio.gather(*requests, return_exceptions=True)
+
+
+async def poller(base, interval, results):
+    "Fetches the page and the tracklist, like a client without change notifications"
+    async with aiohttp.ClientSession() as session:
+        etag = None
+        while True:
+            await results.timed("GET /", session, "GET", f"{base}/")
+            headers = {"If-None-Match": etag} if etag else {}
+            response = await results.timed("GET /tracks", session, "GET", f"{base}/tracks", headers=headers)
+            if response is not None and response.headers.get("ETag"):
+                etag = response.headers["ETag"]
+            await asyncio.sleep(interval)
+
+
+async def run(args, pid):
+    base = f"http://127.0.0.1:{args.port}"
+    results = Results()
+    loads = [asyncio.create_task(subscriber(base, results)) for _ in range(args.subscribers)]
+    # Let subscribers connect before measuring
+    await asyncio.sleep(0.5)
+    rssBefore = residentSize(pid)
+    if args.post_rate > 0:
+        loads.append(asyncio.create_task(poster(base, args.post_rate, args.distinct_queries, results)))
+    loads += [asyncio.create_task(poller(base, args.poll_interval, results)) for _ in range(args.pollers)]
+
+    await asyncio.sleep(args.duration)
+    rssAfter = residentSize(pid)
+    for load in loads:
+        load.cancel()
+    await asyncio.gather(*loads, return_exceptions=True)
+    return results, rssBefore, rssAfter
+
+
+def report(args, results, rssBefore, rssAfter):
+    print(f"{'request':<14}{'count':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}  statuses")
+    for kind in sorted(results.statuses):
+        latencies = sorted(results.latencies[kind])
+        count = sum(results.statuses[kind].values())
+        statuses = " ".join(f"{status}:{n}" for status, n in sorted(results.statuses[kind].items()))
+        if latencies:
+            p50, p99 = (1000 * percentile(latencies, f) for f in (0.5, 0.99))
+            print(f"{kind:<14}{count:>8}{count / args.duration:>10.1f}{p50:>10.2f}{p99:>10.2f}  {statuses}")
+        else:
+            print(f"{kind:<14}{count:>8}{count / args.duration:>10.1f}{'-':>10}{'-':>10}  {statuses}")
+    print(f"change events received: {results.events} ({results.events / args.duration:.1f}/s "
+          f"over {args.subscribers} subscribers)")
+    if results.errors:
+        print("client errors: " + " ".join(f"{name}:{n}" for name, n in results.errors.items()))
+    print(f"server RSS: {rssBefore} KiB with subscribers connected, {rssAfter} KiB at the end")
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog="jukebox.bench", description="Load test the jukebox server offline, with a fake search engine and media player")
+    parser.add_argument("-t", "--duration", type=float, help="seconds to apply the load for (default: 10)", default=10)
+    parser.add_argument("-S", "--subscribers", type=int, help="concurrent /changes subscribers (default: 100)", default=100)
+    parser.add_argument("-P", "--post_rate", type=float, help="POST /tracks requests per second (default: 5)", default=5)
+    parser.add_argument("-q", "--distinct_queries", type=int, help="number of different queries posted, the rest hit the cache (default: 50)", default=50)
+    parser.add_argument("-g", "--pollers", type=int, help="clients polling GET / and GET /tracks (default: 10)", default=10)
+    parser.add_argument("--poll_interval", type=float, help="seconds between polls of each poller (default: 0.1)", default=0.1)
+    parser.add_argument("--find_time", type=float, help="seconds a fake search takes (default: 0.2)", default=0.2)
+    parser.add_argument("--resolve_time", type=float, help="seconds a fake format resolution takes (default: 0.3)", default=0.3)
+    parser.add_argument("--call_time", type=float, help="seconds a fake DBus round trip takes (default: 0.001)", default=0.001)
+    parser.add_argument("--track_length", type=float, help="seconds the fake player plays each track (default: 5)", default=5)
+    parser.add_argument("-w", "--search_workers", type=int, help="number of search worker threads (default: as the server)", default=None)
+    parser.add_argument("-p", "--port", type=int, help="port the server listens to (default: any free one)", default=None)
+
+    args = parser.parse_args()
+    args.port = args.port or freePort()
+
+    options = {
+        "searchWorkers": args.search_workers,
+        # Every request comes from the same address
+        "rateLimit": 1e9,
+        "findTime": args.find_time,
+        "resolveTime": args.resolve_time,
+        "callTime": args.call_time,
+        "trackLength": args.track_length,
+    }
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    server = context.Process(target=runServer, args=(args.port, options, ready))
+    server.start()
+    try:
+        if not ready.wait(timeout=30):
+            raise SystemExit("Server did not start")
+        results, rssBefore, rssAfter = asyncio.run(run(args, server.pid))
+        report(args, results, rssBefore, rssAfter)
+    finally:
+        server.terminate()
+        server.join()
@@ -0,0 +1,126 @@
+# Offline stand-ins for the search engine and the media player
+import asyncio
+import hashlib
+import os
+import signal
+import time
+
+from contextlib import redirect_stdout
+
+from jukebox.server.tracklist import Publisher, QueueState, Track
+
+
+class FakeFinder:
+    "Same interface as YouTubeFinder. Blocks a worker thread for a fixed time, like an extraction would."
+
+    def __init__(self, findTime=0.2, resolveTime=0.3):
+        self.findTime = findTime
+        self.resolveTime = resolveTime
+
+    def warmup(self):
+        pass
+
+    def search(self, query):
+        video_id, _ = self.find(query)
+        return self.resolve(video_id)
+
+    def find(self, query):
+        time.sleep(self.findTime)
+        video_id = hashlib.sha1(query.encode()).hexdigest()[:11]
+        return video_id, query
+
+    def resolve(self, video_id):
+        time.sleep(self.resolveTime)
+        return Track(video_id, f"Track {video_id}", "", ["bench"], f"https://media.invalid/{video_id}")
+
+
+class FakeQueue(Publisher):
+    """
+    Same interface as Queue, with a player that answers every DBus call
+    after 'callTime' seconds, one at a time, and plays each track for
+    'trackLength' seconds.
+    """
+
+    def __init__(self, callTime=0.001, trackLength=5.0):
+        super().__init__("bench")
+        self.callTime = callTime
+        self.trackLength = trackLength
+        self.tracklist_lock = asyncio.Lock()
+        # Held by the call the player is answering
+        self.player = asyncio.Lock()
+        self.handlers = asyncio.create_task(self.play())
+
+    async def call(self):
+        "A DBus round trip to the player"
+        async with self.player:
+            await asyncio.sleep(self.callTime)
+
+    async def addTrack(self, track):
+        await self.addTracks([track])
+
+    async def addTracks(self, tracks):
+        if not tracks:
+            return
+        # Like Queue: publish under the lock, and send one AddTrack per track
+        # without waiting for each reply. Ids come from signals: no more calls.
+        async with self.tracklist_lock:
+            self.version += 1
+            self.tracklist.extend(tracks)
+            self.notifyListChange(QueueState(self), {"op": "append", "tracks": tracks})
+            calls = [asyncio.create_task(self.call()) for _ in tracks]
+        await asyncio.gather(*calls)
+
+    async def removeTrack(self, key):
+        async with self.tracklist_lock:
+            track = self.tracklist.at(key) if isinstance(key, int) else self.tracklist.findVideo(key)
+            if track is None:
+                raise KeyError(key)
+            self.version += 1
+            await self.call()
+            if track is self.tracklist.head():
+                played = time.time()
+                self.tracklist.advance(1, played)
+                self.notifyListChange(QueueState(self), {"op": "advance", "count": 1, "played": played})
+            else:
+                position = self.tracklist.position(track)
+                self.tracklist.remove(track)
+                self.notifyListChange(QueueState(self), {"op": "remove", "position": position})
+
+    async def play(self):
+        "Moves on to the next track every 'trackLength' seconds"
+        while True:
+            await asyncio.sleep(self.trackLength)
+            async with self.tracklist_lock:
+                if self.tracklist:
+                    self.version += 1
+                    played = time.time()
+                    self.tracklist.advance(1, played)
+                    self.notifyListChange(QueueState(self), {"op": "advance", "count": 1, "played": played})
+
+    async def cleanup(self, deadline=2.0):
+        self.handlers.cancel("Cleanup")
+        await self.closeListeners(deadline)
+
+
+async def serve(port, options, ready):
+    from jukebox.server.server import Server
+
+    loop = asyncio.get_running_loop()
+    stopRequested = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, lambda: stopRequested.done() or stopRequested.set_result(None))
+
+    queue = FakeQueue(callTime=options.pop("callTime"), trackLength=options.pop("trackLength"))
+    finder = FakeFinder(findTime=options.pop("findTime"), resolveTime=options.pop("resolveTime"))
+    server = Server("127.0.0.1", port, queue, finder=finder, **options)
+    try:
+        await server.start()
+        ready.set()
+        await stopRequested
+    finally:
+        await server.stop()
+
+
+def runServer(port, options, ready):
+    "Entry point of the benchmarked server process. Its log would get mixed with the report."
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        asyncio.run(serve(port, options, ready))
@@ -0,0 +1,238 @@
+# A fake MPRIS media player, served on a private message bus
+import asyncio
+import tempfile
+
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from jeepney import DBusAddress, new_error, new_method_return, new_signal
+from jeepney.bus_messages import DBusNameFlags, HeaderFields, MatchRule, message_bus
+from jeepney.io.asyncio import Proxy
+
+from jukebox.dbus.org_mpris_MediaPlayer2 import MediaPlayer2, Player, TrackList
+
+
+busConfig = """<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:dir={directory}</listen>
+  <auth>EXTERNAL</auth>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+"""
+
+
+@asynccontextmanager
+async def privateBus(daemon="dbus-daemon"):
+    "Runs a message bus of our own for the duration of the context. Yields its address."
+    with tempfile.TemporaryDirectory(prefix="jukebox-bus-") as directory:
+        config = Path(directory) / "bus.conf"
+        config.write_text(busConfig.format(directory=directory))
+        process = await asyncio.create_subprocess_exec(
+                        daemon, f"--config-file={config}", "--nofork", "--nopidfile", "--print-address=1",
+                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        try:
+            address = (await process.stdout.readline()).decode().strip()
+            if not address:
+                raise RuntimeError(f"{daemon} did not start")
+            yield address
+        finally:
+            if process.returncode is None:
+                process.terminate()
+            await process.wait()
+
+
+class FakePlayer:
+    """
+    Implements the parts of org.mpris.MediaPlayer2.Player and TrackList that
+    Queue uses, and emits the signals it listens to. Every method call is
+    answered after 'latency' seconds, one at a time, like a player's main loop.
+    """
+
+    busName = "org.mpris.MediaPlayer2.fake"
+    path = "/org/mpris/MediaPlayer2"
+    trackIdPrefix = "/org/mpris/MediaPlayer2/TrackList/"
+    noTrack = "/org/mpris/MediaPlayer2/TrackList/NoTrack"
+
+    def __init__(self, router, latency=0.0, trackLength=180):
+        self.router = router
+        self.latency = latency
+        # Reported length of every track, in seconds
+        self.trackLength = trackLength
+        # List of (track id, uri), and position of the current one
+        self.tracks = []
+        self.current = None
+        self.status = "Stopped"
+        self.lastId = 0
+        self.serving = None
+        # Signals emitted while handling a call, sent before its reply
+        self.outbox = []
+        # Method calls handled, by member
+        self.calls = {}
+
+    async def start(self):
+        calls = self.router.filter(MatchRule(type="method_call"), bufsize=0)
+        self.serving = asyncio.create_task(self.serve(calls))
+        reply, = await Proxy(message_bus, self.router).RequestName(self.busName, DBusNameFlags.do_not_queue)
+        if reply != 1:
+            raise RuntimeError(f"Could not own {self.busName}")
+
+    async def stop(self):
+        if self.serving is not None:
+            self.serving.cancel()
+
+    async def serve(self, calls):
+        with calls as calls:
+            while True:
+                message = await calls.get()
+                if self.latency > 0:
+                    await asyncio.sleep(self.latency)
+                member = message.header.fields.get(HeaderFields.member, "")
+                self.calls[member] = self.calls.get(member, 0) + 1
+                try:
+                    reply = self.handle(message, member)
+                except KeyError as error:
+                    reply = new_error(message, "org.freedesktop.DBus.Error.InvalidArgs", "s", (str(error),))
+                await self.flush()
+                await self.router.send(reply)
+
+    async def flush(self):
+        "Sends the signals emitted so far"
+        outbox, self.outbox = self.outbox, []
+        for signal in outbox:
+            await self.router.send(signal)
+
+    def handle(self, message, member):
+        interface = message.header.fields.get(HeaderFields.interface, None)
+        if interface == "org.freedesktop.DBus.Properties" and member == "Get":
+            name, prop = message.body
+            return new_method_return(message, "v", (self.properties(name)[prop],))
+        if interface == "org.freedesktop.DBus.Properties" and member == "GetAll":
+            name, = message.body
+            return new_method_return(message, "a{sv}", (self.properties(name),))
+
+        if interface == Player.interface and member == "Next":
+            self.goTo(self.current + 1 if self.current is not None else None)
+        elif interface == Player.interface and member == "Previous":
+            self.goTo(max(0, self.current - 1) if self.current is not None else None)
+        elif interface == Player.interface and member in ("Play", "PlayPause") and self.tracks:
+            self.goTo(self.current or 0)
+        elif interface == Player.interface and member == "Stop":
+            self.goTo(None)
+        elif interface == TrackList.interface and member == "AddTrack":
+            self.addTrack(*message.body)
+        elif interface == TrackList.interface and member == "RemoveTrack":
+            self.removeTrack(*message.body)
+        elif interface == TrackList.interface and member == "GoTo":
+            trackId, = message.body
+            self.goTo(self.position(trackId))
+        elif interface == TrackList.interface and member == "GetTracksMetadata":
+            trackIds, = message.body
+            metadata = [self.metadata(self.position(trackId)) for trackId in trackIds]
+            return new_method_return(message, "aa{sv}", (metadata,))
+        else:
+            return new_error(message, "org.freedesktop.DBus.Error.UnknownMethod", "s",
+                             (f"Unknown method {interface}.{member}",))
+        return new_method_return(message)
+
+    def properties(self, interface):
+        if interface == Player.interface:
+            return {
+                "PlaybackStatus": ("s", self.status),
+                "Metadata": ("a{sv}", self.metadata(self.current)),
+                "CanGoNext": ("b", self.current is not None and self.current + 1 < len(self.tracks)),
+                "CanControl": ("b", True),
+            }
+        if interface == TrackList.interface:
+            return {
+                "Tracks": ("ao", [trackId for trackId, _ in self.tracks]),
+                "CanEditTracks": ("b", True),
+            }
+        if interface == MediaPlayer2.interface:
+            return {"Identity": ("s", "Fake player"), "HasTrackList": ("b", True)}
+        raise KeyError(interface)
+
+    def position(self, trackId):
+        for i, (t, _) in enumerate(self.tracks):
+            if t == trackId:
+                return i
+        raise KeyError(trackId)
+
+    def metadata(self, position):
+        if position is None:
+            return {}
+        trackId, uri = self.tracks[position]
+        return {
+            "mpris:trackid": ("o", trackId),
+            "xesam:url": ("s", uri),
+            "mpris:length": ("x", self.trackLength * 1000000),
+        }
+
+    def addTrack(self, uri, after, setAsCurrent):
+        self.lastId += 1
+        trackId = f"{self.trackIdPrefix}{self.lastId}"
+        try:
+            position = self.position(after) + 1
+        except KeyError:
+            # e.g. NoTrack or Append: at the end
+            position = len(self.tracks)
+        self.tracks.insert(position, (trackId, uri))
+        if self.current is not None and position <= self.current:
+            self.current += 1
+        self.emit(TrackList.interface, "TrackAdded", "a{sv}o", (self.metadata(position), after))
+        self.propertiesChanged(TrackList.interface, {}, ["Tracks"])
+        if setAsCurrent:
+            self.goTo(position)
+
+    def removeTrack(self, trackId):
+        position = self.position(trackId)
+        del self.tracks[position]
+        self.emit(TrackList.interface, "TrackRemoved", "o", (trackId,))
+        self.propertiesChanged(TrackList.interface, {}, ["Tracks"])
+        if self.current is not None:
+            if position < self.current:
+                self.current -= 1
+            elif position == self.current:
+                self.goTo(self.current)
+
+    def goTo(self, position):
+        "Plays the track at the given position. Stops when there is no such track."
+        if position is None or position >= len(self.tracks):
+            self.current = None
+            self.status = "Stopped"
+            self.propertiesChanged(Player.interface, {"PlaybackStatus": ("s", "Stopped")}, [])
+        else:
+            self.current = position
+            self.status = "Playing"
+            self.propertiesChanged(Player.interface, {
+                "PlaybackStatus": ("s", "Playing"),
+                "Metadata": ("a{sv}", self.metadata(position)),
+                "CanGoNext": ("b", position + 1 < len(self.tracks)),
+            }, [])
+
+    async def trackEnded(self):
+        "The current track played until the end. Moves on to the next one, like Next."
+        self.goTo(self.current + 1 if self.current is not None else None)
+        await self.flush()
+
+    async def storm(self, count):
+        """
+        Emits 'count' PropertiesChanged signals back to back, repeating the
+        current metadata, like a player reporting a stream's buffering does
+        """
+        changed = {"Metadata": ("a{sv}", self.metadata(self.current))}
+        for _ in range(count):
+            self.propertiesChanged(Player.interface, changed, [])
+        await self.flush()
+
+    def propertiesChanged(self, interface, changed, invalidated):
+        self.emit("org.freedesktop.DBus.Properties", "PropertiesChanged", "sa{sv}as",
+                  (interface, changed, invalidated))
+
+    def emit(self, interface, member, signature, body):
+        self.outbox.append(new_signal(DBusAddress(self.path, interface=interface), member, signature, body))
@@ -0,0 +1,137 @@
+# Micro-benchmarks of Queue against a fake media player on a private message bus
+import argparse
+import asyncio
+import os
+import time
+
+from contextlib import redirect_stdout
+
+from jeepney.io.asyncio import open_dbus_router
+
+from jukebox.bench.player import FakePlayer, privateBus
+from jukebox.server import metrics
+from jukebox.server.tracklist import Queue, Track
+
+
+def summary(name, latencies):
+    latencies = sorted(latencies)
+    at = lambda fraction: 1000 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+    total = sum(latencies)
+    return (f"{name:<20}{len(latencies):>8}{len(latencies) / total:>10.1f}"
+            f"{at(0.5):>10.2f}{at(0.99):>10.2f}")
+
+
+def signalsReceived():
+    return sum(series.value for series in metrics.signals.series.values())
+
+
+class Changes:
+    "Lets a benchmark wait for the queue to publish a change"
+
+    def __init__(self, queue):
+        self.changed = asyncio.Event()
+        queue.addObserver(lambda state: self.changed.set())
+
+    async def next(self, timeout=5):
+        await asyncio.wait_for(self.changed.wait(), timeout)
+        self.changed.clear()
+
+
+async def benchAddTrack(queue, count):
+    latencies = []
+    for i in range(count):
+        track = Track(f"video{i}", f"Track {i}", "", [], f"https://media.invalid/{i}")
+        start = time.monotonic()
+        await queue.addTrack(track)
+        latencies.append(time.monotonic() - start)
+    return latencies
+
+
+async def benchAddTracks(queue, count, batch):
+    "Latency of adding 'batch' tracks at once"
+    latencies = []
+    for i in range(0, count, batch):
+        tracks = [Track(f"batch{j}", f"Track {j}", "", [], f"https://media.invalid/batch{j}")
+                  for j in range(i, min(count, i + batch))]
+        start = time.monotonic()
+        await queue.addTracks(tracks)
+        latencies.append(time.monotonic() - start)
+    return latencies
+
+
+async def benchSongChanged(queue, player, changes, count):
+    "Time from the player moving on to the next track until the queue publishes it"
+    latencies = []
+    for _ in range(count):
+        if player.current is None or player.current + 1 >= len(player.tracks):
+            break
+        changes.changed.clear()
+        start = time.monotonic()
+        await player.trackEnded()
+        await changes.next()
+        latencies.append(time.monotonic() - start)
+    return latencies
+
+
+async def benchStorm(player, count, idle=0.2):
+    """
+    Emits a burst of signals and waits until the queue stops receiving them.
+    Returns how many it received and for how long it was busy.
+    """
+    before = signalsReceived()
+    start = last = time.monotonic()
+    await player.storm(count)
+    received = before
+    while received - before < count:
+        await asyncio.sleep(0.01)
+        if (now := signalsReceived()) != received:
+            received, last = now, time.monotonic()
+        elif time.monotonic() - last > idle:
+            break
+    # Let the song change handlers scheduled by the signals finish
+    await asyncio.sleep(0)
+    return received - before, last - start
+
+
+async def main(args):
+    async with privateBus(args.dbus_daemon) as address, \
+               open_dbus_router(bus=address) as playerRouter, \
+               open_dbus_router(bus=address) as queueRouter:
+        player = FakePlayer(playerRouter, latency=args.latency)
+        await player.start()
+        queue = Queue(queueRouter, FakePlayer.busName)
+        await queue.handlers
+        changes = Changes(queue)
+
+        print(f"{'benchmark':<20}{'count':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        # Queue logs every step: keep that cost, but not the output
+        with open(os.devnull, "w") as devnull:
+            with redirect_stdout(devnull):
+                added = await benchAddTrack(queue, args.tracks)
+            print(summary("addTrack", added))
+            with redirect_stdout(devnull):
+                batches = await benchAddTracks(queue, args.tracks, args.batch)
+            print(summary(f"addTracks ({args.batch})", batches))
+            with redirect_stdout(devnull):
+                changed = await benchSongChanged(queue, player, changes, 2 * args.tracks - 1)
+            print(summary("handleSongChanged", changed))
+            with redirect_stdout(devnull):
+                received, busy = await benchStorm(player, args.storm)
+            print(f"signal storm: {received} of {args.storm} signals received in {1000 * busy:.1f} ms"
+                  f" ({received / busy if busy else 0:.0f}/s), {args.storm - received} dropped")
+
+        print("player calls: " + " ".join(f"{name}:{n}" for name, n in sorted(player.calls.items())))
+        await queue.cleanup()
+        await player.stop()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog="jukebox.bench.tracklist", description="Benchmark Queue against a fake media player on a private message bus")
+    parser.add_argument("-n", "--tracks", type=int, help="tracks to add one by one, then in batches, and then play through (default: 200)", default=200)
+    parser.add_argument("-b", "--batch", type=int, help="tracks added at once in the batch benchmark (default: 20)", default=20)
+    parser.add_argument("-s", "--storm", type=int, help="signals emitted back to back in the signal storm (default: 1000)", default=1000)
+    parser.add_argument("-l", "--latency", type=float, help="seconds the player takes to answer each method call (default: 0)", default=0)
+    parser.add_argument("--dbus_daemon", help="message bus daemon executable (default: 'dbus-daemon')", default="dbus-daemon")
+
+    asyncio.run(main(parser.parse_args()))
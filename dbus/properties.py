@@ -1,4 +1,5 @@
 from jeepney import Properties
+from jeepney.io.asyncio import Proxy
 from jukebox.dbus.org_mpris_MediaPlayer2 import MediaPlayer2, Player, TrackList
 
 
@@ -87,3 +88,64 @@ class TrackListProperties(Properties):
 
     def CanEditTracks(self):
         return self.get("CanEditTracks")
+
+
+class PropertyMirror:
+    """
+    Local copy of an object's properties, so that reading them costs no bus
+    traffic. Filled with one GetAll per interface, then kept up to date by
+    feeding it the object's PropertiesChanged signals. Properties signaled
+    as invalidated (changed without telling the new value) are dropped until
+    fetched again.
+    """
+
+    def __init__(self, router, busName, objects):
+        self.router = router
+        self.busName = busName
+        # MessageGenerators of the mirrored interfaces (e.g. Player(), TrackList()), by interface name
+        self.objects = {obj.interface: obj for obj in objects}
+        # Property values (without variant signature) by interface
+        self.values = {interface: {} for interface in self.objects}
+
+    def proxy(self, interface):
+        properties = Properties(self.objects[interface])
+        properties.props_if.bus_name = self.busName
+        return Proxy(properties, self.router)
+
+    async def sync(self, interface=None):
+        "Reads every property of one or all of the interfaces again"
+        for name in [interface] if interface is not None else list(self.objects):
+            response, = await self.proxy(name).get_all()
+            self.values[name] = {prop: value for prop, (signature, value) in response.items()}
+
+    async def fetch(self, interface, prop):
+        "Reads a property from the object, updating the copy"
+        response, = await self.proxy(interface).get(prop)
+        signature, value = response
+        self.values[interface][prop] = value
+        return value
+
+    def get(self, interface, prop, default=None):
+        "Latest known value of a property, or default if unknown or invalidated"
+        return self.values[interface].get(prop, default)
+
+    async def read(self, interface, prop):
+        "Latest known value of a property, fetching it only if unknown or invalidated"
+        if prop in self.values[interface]:
+            return self.values[interface][prop]
+        return await self.fetch(interface, prop)
+
+    def assume(self, interface, prop, value):
+        "Records a value the object is expected to signal soon"
+        self.values[interface][prop] = value
+
+    def update(self, signalMessage):
+        "Applies a PropertiesChanged signal. Returns whether it was for a mirrored interface."
+        interface, changed, invalidated = signalMessage.body
+        values = self.values.get(interface, None)
+        if values is None:
+            return False
+        values.update({prop: value for prop, (signature, value) in changed.items()})
+        for prop in invalidated:
+            values.pop(prop, None)
+        return True
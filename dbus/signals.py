@@ -50,7 +50,7 @@ class TrackAdded(MatchRule):
         super().__init__(
             type="signal",
             sender=sender,
-            interface=PropertiesChanged.interface,
+            interface=self.interface,
             path=object_path,
             member=self.member,
         )
@@ -68,7 +68,7 @@ class TrackRemoved(MatchRule):
         super().__init__(
             type="signal",
             sender=sender,
-            interface=PropertiesChanged.interface,
+            interface=self.interface,
             path=object_path,
             member=self.member,
         )
@@ -86,7 +86,7 @@ class TrackMetadataChanged(MatchRule):
         super().__init__(
             type="signal",
             sender=sender,
-            interface=PropertiesChanged.interface,
+            interface=self.interface,
             path=object_path,
             member=self.member,
         )
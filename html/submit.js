@@ -4,13 +4,23 @@ var domThumbnail = null;
 var domNextList = null;
 var domForm = null;
 
+// Local copy of the tracklist, and its etag ("<epoch>-<version>")
+var tracks = [];
+var etag = null;
+
+// Push channel to the server, when the browser supports WebSockets
+var socket = null;
+
 // Resets #current and #playlist div elements with the latest values of
 // current and following variables
 // Assume all the dom elements have been queried (onLoad() was called)
 function updateList(queue) {
     if (queue.length > 0 && queue[0] != null) {
         domTitle.innerHTML = queue[0].title;
-        domThumbnail.src = queue[0].caption;
+        // Served by the jukebox and cached by the browser. Only reload on change.
+        let thumbnail = "/thumbnails/" + queue[0].id;
+        if (domThumbnail.getAttribute("src") != thumbnail)
+            domThumbnail.src = thumbnail;
         domCurrent.classList.remove("undefined");
     } else {
         domCurrent.classList.add("undefined");
@@ -40,6 +50,38 @@ function updateList(queue) {
     }
 }
 
+// Whether etag 'a' identifies a newer tracklist than etag 'b'
+function isNewer(a, b) {
+    if (b == null)
+        return true;
+    let [epochA, versionA] = [a.slice(0, a.lastIndexOf("-")), Number(a.slice(a.lastIndexOf("-") + 1))];
+    let [epochB, versionB] = [b.slice(0, b.lastIndexOf("-")), Number(b.slice(b.lastIndexOf("-") + 1))];
+    return epochA != epochB || versionA > versionB;
+}
+
+// Applies a change to the local copy of the tracklist and updates the page.
+// Changes already included in the local copy are ignored.
+function applyChange(change) {
+    if (change.op != "snapshot" && !isNewer(change.etag, etag))
+        return;
+    switch (change.op) {
+        case "snapshot":
+            tracks = change.tracks;
+            break;
+        case "append":
+            tracks = tracks.concat(change.tracks);
+            break;
+        case "advance":
+            tracks = tracks.slice(change.count);
+            break;
+        case "remove":
+            tracks.splice(change.position, 1);
+            break;
+    }
+    etag = change.etag;
+    updateList(tracks);
+}
+
 function doSubmit() {
     var url = "/tracks";
     var method = "POST";
@@ -47,6 +89,12 @@ function doSubmit() {
     if (postData.length == 0)
         return;
 
+    // Submit over the open WebSocket, saving a request. The change arrives as an event.
+    if (socket != null && socket.readyState == WebSocket.OPEN) {
+        socket.send(JSON.stringify({"query": postData}));
+        return;
+    }
+
     // Send POST request
     fetch(url, {
         "method": "POST",
@@ -54,11 +102,14 @@ function doSubmit() {
         "body": postData
     }).then((response) => {
         if (response.ok)
-            return response.json();
+            return response.json().then((json) => [response.headers.get("ETag"), json]);
         else
             throw response;
-    }).then((json) => {
-        updateList(json);
+    }).then(([tag, json]) => {
+        // The change might have been received already as an event
+        tag = tag.replace(/^W\//, "").replace(/"/g, "");
+        if (isNewer(tag, etag))
+            applyChange({"op": "snapshot", "etag": tag, "tracks": json});
     });
 }
 
@@ -76,11 +127,40 @@ function onLoad() {
         doSubmit(); // Invoke custom HTTP request
     });
 
-    // Subscribe to server-sent song change events
-    const evtSource = new EventSource("/changes");
-    evtSource.onmessage = function(event) {
-      queue = JSON.parse(event.data); // 'event.data' contains the new state
-      etag = queue.etag;
-      updateList(queue.tracks);
+    if ("WebSocket" in window) {
+        connectWebSocket();
+    } else {
+        // Subscribe to server-sent tracklist changes. The first event is a
+        // snapshot of the tracklist. When reconnecting, the browser sends the
+        // last event id and the server replies with the changes we missed.
+        const evtSource = new EventSource("/changes");
+        evtSource.onmessage = function(event) {
+          applyChange(JSON.parse(event.data));
+        }
+    }
+}
+
+// Receives tracklist changes and submission results over a WebSocket.
+// Reconnects after losing the connection, asking for the changes we missed.
+function connectWebSocket() {
+    let scheme = location.protocol == "https:" ? "wss://" : "ws://";
+    let since = etag != null ? "?since=" + encodeURIComponent(etag) : "";
+    let decoder = new TextDecoder();
+
+    socket = new WebSocket(scheme + location.host + "/ws" + since);
+    socket.binaryType = "arraybuffer";
+    socket.onmessage = function(event) {
+        let data = typeof event.data == "string" ? event.data : decoder.decode(event.data);
+        let message = JSON.parse(data);
+        if (message.op == "result") {
+            if (message.status != "queued")
+                console.warn("Could not queue track: " + message.error);
+        } else {
+            applyChange(message);
+        }
+    }
+    socket.onclose = function() {
+        socket = null;
+        setTimeout(connectWebSocket, 1000);
     }
 }
@@ -0,0 +1,83 @@
+# Admission control for search requests
+import math
+import time
+
+from jukebox.server.cache import LRUCache
+
+
+class Rejected(Exception):
+    "A request was not admitted. Carries the HTTP status and how many seconds to wait before retrying"
+
+    def __init__(self, status, retryAfter, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retryAfter = max(1, math.ceil(retryAfter))
+        self.reason = reason
+
+
+class TokenBucket:
+    "Allows bursts of up to 'burst' requests and 'rate' requests per second on average"
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, count=1):
+        """
+        Takes 'count' tokens if available. Otherwise, returns the seconds until
+        there are. More than 'burst' tokens can only be taken from a full
+        bucket, which is left in debt until refilled.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(count, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= count
+            return 0
+        return (needed - self.tokens) / self.rate
+
+
+class AdmissionControl:
+    """
+    Rate limits search requests per client, and bounds the number of searches
+    waiting for or running in the search executor so that admitted requests
+    are not queued behind an unbounded backlog.
+    """
+
+    # Smoothing factor of the average search duration
+    alpha = 0.2
+
+    def __init__(self, maxPending, rate=10 / 60, burst=5, maxClients=4096):
+        self.maxPending = maxPending
+        self.rate = rate
+        self.burst = burst
+        # Token bucket by client address. Forget the least recently seen ones.
+        self.clients = LRUCache(maxClients)
+        # Searches submitted to the executor and not finished yet
+        self.pending = 0
+        # Estimated duration of a background search, in seconds
+        self.searchTime = 2.0
+
+    def admit(self, client, count=1):
+        "Takes 'count' requests from the client's allowance, or raises Rejected (429)"
+        bucket = self.clients.get(client, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.clients.put(client, bucket)
+        wait = bucket.take(count)
+        if wait > 0:
+            raise Rejected(429, wait, "Too many requests")
+
+    def reserve(self):
+        "Takes a slot for a background search, or raises Rejected (503) if the backlog is full"
+        if self.pending >= self.maxPending:
+            raise Rejected(503, self.searchTime, "Too many searches in progress")
+        self.pending += 1
+
+    def release(self, duration):
+        "Frees a search slot, accounting how long its search took"
+        self.pending -= 1
+        self.searchTime += AdmissionControl.alpha * (duration - self.searchTime)
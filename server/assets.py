@@ -0,0 +1,91 @@
+# Static assets served from memory: precompressed, and fingerprinted so browsers can cache them for good
+import gzip
+import hashlib
+import mimetypes
+
+from contextlib import suppress
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def acceptedEncodings(request):
+    "Content codings the client accepts, ignoring the ones explicitly refused (q=0)"
+    accepted = set()
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        key, _, value = params.partition("=")
+        quality = 1.0
+        if key.strip() == "q":
+            with suppress(ValueError):
+                quality = float(value)
+        if quality > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+class Asset:
+    "Contents of a file in every encoding worth serving"
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = path.stat().st_mtime
+        body = path.read_bytes()
+
+        self.contentType, _ = mimetypes.guess_type(path.name)
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.url = f"/assets/{path.stem}.{self.digest}{path.suffix}"
+
+        # Preferred encodings first
+        self.variants = {}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body)
+        self.variants["gzip"] = gzip.compress(body, 9)
+        # Do not bother with encodings that don't reduce the size
+        self.variants = {coding: data for coding, data in self.variants.items() if len(data) < len(body)}
+        self.variants["identity"] = body
+
+    def select(self, request):
+        "Returns the encoding and contents to send to the client"
+        accepted = acceptedEncodings(request)
+        for coding, data in self.variants.items():
+            if coding in accepted or coding == "identity":
+                return coding, data
+
+
+class Assets:
+    "Files in the assets directory, by their plain name and by their fingerprinted name"
+
+    patterns = ("*.js", "*.css")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.assets = {}
+        self.load()
+
+    def load(self):
+        self.assets = {path.name: Asset(path)
+                       for pattern in Assets.patterns for path in self.directory.glob(pattern)}
+        self.fingerprinted = {asset.url.rpartition("/")[2]: asset for asset in self.assets.values()}
+
+    def reload(self):
+        "Loads the assets again if any of them was modified. Returns whether it did."
+        modified = any(asset.path.stat().st_mtime != asset.mtime for asset in self.assets.values())
+        if modified:
+            self.load()
+        return modified
+
+    def url(self, name):
+        "Fingerprinted url of an asset, which is valid for as long as its contents stay the same"
+        return self.assets[name].url
+
+    def get(self, filename):
+        """
+        Returns the asset for a file name, and whether that name is fingerprinted
+        (and can be cached indefinitely). Returns (None, False) if unknown.
+        """
+        if (asset := self.fingerprinted.get(filename, None)) is not None:
+            return asset, True
+        return self.assets.get(filename, None), False
@@ -0,0 +1,129 @@
+# Bounded in-memory caches for search results
+import asyncio
+import re
+import time
+
+from collections import OrderedDict
+from copy import copy
+
+
+def normalizeQuery(query):
+    "Canonical form of a search query, so that trivially different queries share cache entries"
+    return " ".join(query.casefold().split())
+
+
+def streamExpiry(url):
+    """
+    Returns the expiration timestamp embedded in a googlevideo stream url,
+    either as a query parameter (?expire=N) or as a path segment (/expire/N/)
+    """
+    match = re.search(r"[?&/]expire[=/]([0-9]+)", url or "")
+    return int(match.group(1)) if match else None
+
+
+class LRUCache:
+    """
+    Mapping with a bounded size, least-recently-used eviction and expiration.
+    Size is the number of entries, unless 'sizeof' tells the size of each value.
+    """
+
+    def __init__(self, maxsize, ttl=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        # Key to (value, expiration timestamp) pairs, least recently used first
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires is not None and expires <= time.time():
+            self.pop(key)
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, expires=None):
+        if self.ttl is not None:
+            deadline = time.time() + self.ttl
+            expires = deadline if expires is None else min(expires, deadline)
+        self.pop(key)
+        self.entries[key] = (value, expires)
+        self.size += self.sizeof(value)
+        while self.size > self.maxsize:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.size -= self.sizeof(evicted)
+
+    def pop(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value, _ = self.entries.pop(key)
+        self.size -= self.sizeof(value)
+        return value
+
+
+class TrackCache:
+    "Search results indexed by normalized query and by video id"
+
+    # Stream urls stop working after they expire. Leave some time for the
+    # track to wait in the queue before it is played.
+    expiryMargin = 30 * 60
+
+    def __init__(self, maxsize=512, ttl=6 * 60 * 60):
+        # Normalized query to video id
+        self.queries = LRUCache(maxsize, ttl)
+        # Video id to track
+        self.videos = LRUCache(maxsize, ttl)
+
+    def videoId(self, query):
+        "Returns the video id a query resolved to, which outlives its stream url"
+        return self.queries.get(normalizeQuery(query))
+
+    def get(self, query):
+        video_id = self.videoId(query)
+        return None if video_id is None else self.getById(video_id)
+
+    def getById(self, video_id):
+        track = self.videos.get(video_id)
+        # Tracks are annotated once queued (e.g. tracklist_id), hand out copies
+        return None if track is None else copy(track)
+
+    def put(self, query, track):
+        self.putTrack(track)
+        self.putQuery(query, track.id)
+
+    def putQuery(self, query, video_id):
+        self.queries.put(normalizeQuery(query), video_id)
+
+    def putTrack(self, track):
+        expires = streamExpiry(track.url)
+        if expires is not None:
+            expires -= TrackCache.expiryMargin
+        self.videos.put(track.id, copy(track), expires)
+
+
+class SingleFlight:
+    "Coalesces concurrent calls with the same key into one in-flight task"
+
+    def __init__(self):
+        # Key to task running the call
+        self.calls = {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    async def run(self, key, function):
+        task = self.calls.get(key, None)
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        # One of the callers going away (e.g. client disconnected) must not
+        # cancel the call for everybody else
+        return await asyncio.shield(task)
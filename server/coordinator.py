@@ -0,0 +1,306 @@
+# Several HTTP worker processes sharing a single media player connection.
+# The coordinator process owns the Queue and its DBus connection. Workers
+# mirror the tracklist from the changes the coordinator broadcasts, serve
+# subscribers from their own memory, and forward modifications to it.
+import asyncio
+import json
+import signal
+
+from itertools import count
+
+from jukebox.server import metrics
+from jukebox.server.events import ChangeLog, Event
+from jukebox.server.tracklist import PlayedTrack, Publisher, QueueState, Track
+
+# Snapshots of long tracklists are sent in a single line
+lineLimit = 2**24
+
+
+def encodeTrack(track):
+    "Everything the coordinator needs to queue a track (TrackEncoder only keeps what clients see)"
+    return {"id": track.id, "title": track.title, "caption": track.caption, "tags": track.tags, "url": track.url}
+
+
+def decodeTrack(data):
+    return Track(data["id"], data["title"], data["caption"], data.get("tags", []), data.get("url", None))
+
+
+# Seconds to wait for a worker's metrics
+metricsTimeout = 1.0
+
+
+def parseEtag(etag):
+    "Splits a tracklist etag into epoch and version"
+    epoch, _, version = etag.rpartition("-")
+    return epoch, int(version)
+
+
+class Coordinator:
+    """
+    Serves a Queue to the worker processes over a Unix socket, using newline
+    delimited JSON. Each worker receives a snapshot of the tracklist when it
+    connects, and then every change. Workers send requests:
+        {"id": n, "method": "addTracks", "tracks": [...]}
+        {"id": n, "method": "removeTrack", "track": position or video id}
+    which are replied with the tracklist's etag once done:
+        {"id": n, "etag": "..."} or {"id": n, "error": "...", "type": "..."}
+    A worker serving metrics sends {"id": n, "method": "metrics"}. The
+    coordinator then sends {"id": m, "method": "collect"} to the other
+    workers, which reply {"id": m, "metrics": {...}}, and replies with
+    its own metrics and theirs: {"id": n, "metrics": [{...}, ...]}
+    """
+
+    def __init__(self, queue, path):
+        self.queue = queue
+        self.path = path
+        self.server = None
+        # Connection tasks to their WorkerConnection
+        self.connections = {}
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.serve, path=self.path, limit=lineLimit)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+        for connection in list(self.connections):
+            connection.cancel()
+        await self.queue.cleanup()
+
+    async def serve(self, reader, writer):
+        worker = self.connections[asyncio.current_task()] = WorkerConnection(writer)
+        pusher = asyncio.create_task(self.push(writer))
+        requests = set()
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if "method" in message:
+                    request = asyncio.create_task(self.handle(message, worker))
+                    requests.add(request)
+                    request.add_done_callback(requests.discard)
+                else:
+                    worker.reply(message)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            worker.close()
+            for task in [pusher, *requests]:
+                task.cancel()
+            writer.close()
+
+    async def push(self, writer):
+        "Sends the tracklist changes to a worker, like Server.subscribe does to clients"
+        async with self.queue.createListener() as events:
+            version = -1
+            for event in self.queue.changesSince(None):
+                writer.write(event.data + b"\n")
+                version = event.version
+            while (event := await events.get()) != None:
+                if event.version > version:
+                    writer.write(event.data + b"\n")
+                    version = event.version
+                await writer.drain()
+
+    async def handle(self, request, worker):
+        reply = {"id": request["id"]}
+        try:
+            if request["method"] == "addTracks":
+                await self.queue.addTracks([decodeTrack(track) for track in request["tracks"]])
+                reply["etag"] = self.queue.etag
+            elif request["method"] == "removeTrack":
+                await self.queue.removeTrack(request["track"])
+                reply["etag"] = self.queue.etag
+            elif request["method"] == "metrics":
+                reply["metrics"] = await self.collectMetrics(worker)
+            else:
+                raise ValueError("Unknown method {}".format(request["method"]))
+        except Exception as error:
+            reply = {"id": request["id"], "error": str(error), "type": type(error).__name__}
+        worker.writer.write(json.dumps(reply).encode() + b"\n")
+
+    async def collectMetrics(self, requester):
+        """
+        Metrics of this process and of the workers other than the requester.
+        Workers that don't answer in time are left out.
+        """
+        others = [worker for worker in self.connections.values() if worker is not requester]
+        replies = await asyncio.gather(*[asyncio.wait_for(worker.call("collect"), metricsTimeout)
+                                         for worker in others], return_exceptions=True)
+        return [metrics.registry.collect()] + [reply["metrics"] for reply in replies if isinstance(reply, dict)]
+
+
+class WorkerConnection:
+    "Requests the coordinator sends to a worker, waiting for their reply"
+
+    def __init__(self, writer):
+        self.writer = writer
+        # Requests waiting for the worker's reply, by request id
+        self.requests = {}
+        self.ids = count()
+
+    async def call(self, method):
+        request = next(self.ids)
+        reply = self.requests[request] = asyncio.get_running_loop().create_future()
+        try:
+            self.writer.write(json.dumps({"id": request, "method": method}).encode() + b"\n")
+            return await reply
+        finally:
+            self.requests.pop(request, None)
+
+    def reply(self, message):
+        if (reply := self.requests.get(message["id"], None)) is not None and not reply.done():
+            reply.set_result(message)
+
+    def close(self):
+        for reply in self.requests.values():
+            if not reply.done():
+                reply.set_exception(ConnectionError("Lost connection to worker"))
+
+
+class RemoteQueue(Publisher):
+    """
+    Queue of a worker process: a copy of the coordinator's tracklist.
+    Modifications are sent to the coordinator, and return once the copy
+    includes them, so that the next page or listing a client requests from
+    this worker is up to date.
+    """
+
+    def __init__(self, path):
+        super().__init__(None)
+        self.path = path
+        self.reader = None
+        self.writer = None
+        # Requests waiting for the coordinator's reply, by request id
+        self.requests = {}
+        self.ids = count()
+        # Notified whenever a change is applied to the copy
+        self.updated = asyncio.Condition()
+        # Done when the connection to the coordinator is lost
+        self.handlers = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=lineLimit)
+        self.handlers = asyncio.create_task(self.receive())
+        # The coordinator sends a snapshot first
+        async with self.updated:
+            await self.updated.wait_for(lambda: self.epoch is not None or self.handlers.done())
+
+    async def receive(self):
+        "Applies broadcast changes and completes requests with their replies, until disconnected"
+        try:
+            while line := await self.reader.readline():
+                message = json.loads(line)
+                if "op" in message:
+                    await self.apply(message, line.rstrip(b"\n"))
+                elif message.get("method", None) == "collect":
+                    self.writer.write(json.dumps({"id": message["id"], "metrics": metrics.registry.collect()})
+                                      .encode() + b"\n")
+                elif (reply := self.requests.pop(message["id"], None)) is not None and not reply.done():
+                    reply.set_result(message)
+        except ConnectionError as error:
+            print(f"Connection to coordinator failed: {error}")
+        finally:
+            for reply in self.requests.values():
+                if not reply.done():
+                    reply.set_exception(ConnectionError("Lost connection to coordinator"))
+            self.requests = {}
+            async with self.updated:
+                self.updated.notify_all()
+        print("Disconnected from coordinator")
+
+    async def apply(self, change, data):
+        "Applies a change broadcast by the coordinator, and publishes it unchanged to local listeners"
+        epoch, version = parseEtag(change["etag"])
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.changes = ChangeLog(epoch)
+
+        op = change["op"]
+        if op == "snapshot":
+            history = [PlayedTrack(decodeTrack(track), track["played"]) for track in change.get("history", ())]
+            self.tracklist.reset((decodeTrack(track) for track in change["tracks"]), history)
+        elif op == "append":
+            self.tracklist.extend(decodeTrack(track) for track in change["tracks"])
+        elif op == "advance":
+            self.tracklist.advance(change["count"], change["played"])
+        elif op == "remove":
+            self.tracklist.remove(self.tracklist.at(change["position"]))
+        self.version = version
+        self.publish(QueueState(self), Event(epoch, version, data))
+
+        async with self.updated:
+            self.updated.notify_all()
+
+    async def request(self, method, **arguments):
+        "Sends a request to the coordinator and returns its reply"
+        request = next(self.ids)
+        reply = asyncio.get_running_loop().create_future()
+        self.requests[request] = reply
+        self.writer.write(json.dumps(dict(arguments, id=request, method=method)).encode() + b"\n")
+        await self.writer.drain()
+        reply = await reply
+
+        if "error" in reply:
+            if reply["type"] == "ValueError":
+                raise ValueError(reply["error"])
+            if reply["type"] == "KeyError":
+                raise KeyError(reply["error"])
+            raise RuntimeError(reply["error"])
+        return reply
+
+    async def call(self, method, **arguments):
+        "Sends a request to the coordinator, and waits until this copy includes its result"
+        reply = await self.request(method, **arguments)
+        epoch, version = parseEtag(reply["etag"])
+        async with self.updated:
+            await self.updated.wait_for(lambda: self.epoch != epoch or self.version >= version
+                                                or self.handlers.done())
+
+    async def addTrack(self, track):
+        await self.addTracks([track])
+
+    async def addTracks(self, tracks):
+        if tracks:
+            await self.call("addTracks", tracks=[encodeTrack(track) for track in tracks])
+
+    async def removeTrack(self, key):
+        await self.call("removeTrack", track=key)
+
+    async def collectMetrics(self):
+        "Metrics of the coordinator and of the other workers"
+        return (await self.request("metrics"))["metrics"]
+
+    async def cleanup(self, deadline=2.0):
+        if self.writer is not None:
+            self.writer.close()
+        if self.handlers is not None:
+            self.handlers.cancel("Cleanup")
+        await self.closeListeners(deadline)
+
+
+async def worker(index, path, host, port, options):
+    # Imported here: the coordinator process does not serve HTTP
+    from jukebox.server.server import Server
+
+    # Tells this worker's series apart from the other processes'
+    metrics.registry.constantLabels = [("process", f"worker{index}")]
+
+    loop = asyncio.get_running_loop()
+    stopRequested = loop.create_future()
+    for s in {signal.SIGINT, signal.SIGTERM}:
+        loop.add_signal_handler(s, lambda: stopRequested.done() or stopRequested.set_result(None))
+
+    queue = RemoteQueue(path)
+    await queue.connect()
+    server = Server(host, port, queue, reusePort=True, **options)
+    try:
+        await server.start()
+        await asyncio.wait([stopRequested, queue.handlers], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        await server.stop()
+
+
+def runWorker(index, path, host, port, options):
+    "Entry point of HTTP worker processes"
+    asyncio.run(worker(index, path, host, port, options))
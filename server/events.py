@@ -0,0 +1,115 @@
+# Tracklist change notifications, fanned out to subscribers
+import asyncio
+
+from collections import deque
+
+
+def sseFrame(data, event_id=None, kind=None):
+    """
+    Encodes a server-sent event. Data must be a single line, which is the
+    case for JSON documents encoded without indentation.
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(b"id: " + str(event_id).encode())
+    if kind is not None:
+        lines.append(b"event: " + kind.encode())
+    lines.append(b"data: " + data)
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+class Event:
+    """
+    A tracklist change, serialized once and shared by every subscriber.
+    Subscribers write the same immutable buffers, whatever their number.
+    """
+
+    def __init__(self, epoch, version, data):
+        # Tracklist version after applying the change
+        self.version = version
+        # Same as the tracklist's etag at that version
+        self.id = f"{epoch}-{version}"
+        # JSON document describing the change
+        self.data = data
+        # Same, framed as a server-sent event
+        self.frame = sseFrame(data, self.id)
+
+
+class ChangeLog:
+    """
+    Bounded history of the most recent changes, so that subscribers that
+    reconnect only receive the changes they missed.
+    """
+
+    def __init__(self, epoch, size=64):
+        self.epoch = epoch
+        self.events = deque(maxlen=size)
+
+    def append(self, event):
+        self.events.append(event)
+
+    def since(self, event_id, version):
+        """
+        Returns the events after the given event id, up to the current version.
+        Returns None when they are not available anymore (or never were, e.g.
+        the id belongs to a previous run) and the subscriber needs a snapshot.
+        """
+        epoch, _, seen = (event_id or "").rpartition("-")
+        if epoch != self.epoch or not seen.isdigit():
+            return None
+        seen = int(seen)
+        if seen == version:
+            return []
+        missed = [event for event in self.events if event.version > seen]
+        if not missed or missed[0].version != seen + 1:
+            return None
+        return missed
+
+
+class Channel:
+    """
+    Delivers events to a single subscriber. Publishing never blocks: when a
+    slow subscriber falls too far behind, its pending events are dropped and
+    it receives a snapshot of the latest tracklist instead.
+    """
+
+    def __init__(self, snapshot, size=16):
+        # Returns a snapshot event of the current tracklist
+        self.snapshot = snapshot
+        self.size = size
+        self.pending = deque()
+        # Pending events were dropped, send a snapshot next
+        self.stale = False
+        self.closed = False
+        self.ready = asyncio.Event()
+        # Set while the subscriber is waiting for events (it is not behind)
+        self.drained = asyncio.Event()
+
+    def put(self, event):
+        if self.closed or self.stale:
+            return
+        if len(self.pending) < self.size:
+            self.pending.append(event)
+        else:
+            self.pending.clear()
+            self.stale = True
+        self.drained.clear()
+        self.ready.set()
+
+    def close(self):
+        "No more events. The subscriber receives None once it has consumed the pending ones."
+        self.closed = True
+        self.ready.set()
+
+    async def get(self):
+        while True:
+            if self.stale:
+                self.stale = False
+                return self.snapshot()
+            if self.pending:
+                return self.pending.popleft()
+            self.drained.set()
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
@@ -0,0 +1,199 @@
+# Server metrics, exposed in Prometheus text format
+import time
+
+from contextlib import contextmanager
+
+
+def formatLabels(pairs):
+    "Formats (name, value) label pairs, escaping the values"
+    if not pairs:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    "A metric family: one series for every combination of label values"
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labels)
+        # Label values to series
+        self.series = {}
+        if not self.labelNames:
+            self.series[()] = self.newSeries()
+        registry.register(self)
+
+    def labels(self, *values):
+        "Series for the given label values, created on first use"
+        series = self.series.get(values, None)
+        if series is None:
+            assert len(values) == len(self.labelNames)
+            series = self.series[values] = self.newSeries()
+        return series
+
+    def render(self, constantLabels=()):
+        "Help and type lines, followed by the samples of every series"
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, series in self.series.items():
+            lines.extend(series.samples(self.name, list(constantLabels) + list(zip(self.labelNames, values))))
+        return lines
+
+    # Unlabelled metrics are used as their only series
+    def __getattr__(self, name):
+        if name == "series":
+            raise AttributeError(name)
+        return getattr(self.series[()], name)
+
+
+class CounterSeries:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        return [f"{name}{formatLabels(labels)} {self.value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def newSeries(self):
+        return CounterSeries()
+
+
+class GaugeSeries:
+    def __init__(self):
+        self.value = 0
+        # Reads the value when rendered, instead of having to update it
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def setFunction(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        value = self.value if self.function is None else self.function()
+        return [f"{name}{formatLabels(labels)} {value}"]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def newSeries(self):
+        return GaugeSeries()
+
+
+class HistogramSeries:
+    def __init__(self, buckets):
+        # Upper bounds, in increasing order. The last one is +Inf.
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    @contextmanager
+    def time(self):
+        "Observes the duration of the enclosed block, in seconds"
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+    def samples(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{formatLabels(labels + [('le', le)])} {cumulative}")
+        lines.append(f"{name}_sum{formatLabels(labels)} {self.sum}")
+        lines.append(f"{name}_count{formatLabels(labels)} {cumulative}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    # From a fraction of a millisecond (a DBus round trip, a fan-out) up to
+    # the many seconds an extraction can take
+    defaultBuckets = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                      .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, documentation, labels=(), buckets=defaultBuckets):
+        self.buckets = tuple(buckets) + (float("inf"),)
+        super().__init__(name, documentation, labels)
+
+    def newSeries(self):
+        return HistogramSeries(self.buckets)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # (name, value) label pairs added to every series, e.g. the process they come from
+        self.constantLabels = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def collect(self):
+        "Rendered lines of every metric, by name. Can be sent to another process and merged there."
+        return {metric.name: metric.render(self.constantLabels) for metric in self.metrics}
+
+    def render(self, others=()):
+        """
+        All metrics in Prometheus text exposition format, along with those
+        collected from other processes. Series of the same metric are listed
+        together, under a single help and type line.
+        """
+        families = self.collect()
+        for collected in others:
+            for name, lines in collected.items():
+                if name in families:
+                    families[name].extend(lines[2:])
+                else:
+                    families[name] = list(lines)
+        return "\n".join(line for lines in families.values() for line in lines) + "\n"
+
+
+registry = Registry()
+
+
+def timedCall(function, *args):
+    """
+    Calls a function and returns when it started and finished, along with its
+    result. Run in the search executor to tell queue wait and run time apart.
+    Monotonic time is system wide, so it can be compared across processes.
+    """
+    started = time.monotonic()
+    result = function(*args)
+    return started, time.monotonic(), result
+
+
+searchQueueWait = Histogram("jukebox_search_queue_wait_seconds",
+                            "Time a search step waited for a free search worker", labels=("step",))
+searchExtraction = Histogram("jukebox_search_extraction_seconds",
+                             "Time a search step spent extracting in a search worker", labels=("step",))
+dbusCall = Histogram("jukebox_dbus_call_seconds",
+                     "Round trip of DBus method calls and property reads to the media player", labels=("call",))
+fanout = Histogram("jukebox_notify_fanout_seconds",
+                   "Time to publish a tracklist change to observers and listeners")
+signals = Counter("jukebox_dbus_signals_total", "DBus signals received, by member", labels=("signal",))
+listeners = Gauge("jukebox_listeners", "Clients subscribed to tracklist changes")
+searchBacklog = Gauge("jukebox_search_backlog", "Searches waiting for or running in the search executor")
+queueLength = Gauge("jukebox_queue_length", "Tracks in the tracklist, including the one playing")
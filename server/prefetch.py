@@ -0,0 +1,138 @@
+# Download upcoming tracks ahead of time, so that the player reads them from disk
+import aiohttp
+import asyncio
+
+from collections import OrderedDict
+
+from jeepney import DBusErrorResponse
+
+
+class AudioCache:
+    "Directory of downloaded audio streams bounded in size, evicting the least recently used"
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.size = 0
+        # Video id to (path, size), least recently used first
+        self.entries = OrderedDict()
+
+        directory.mkdir(parents=True, exist_ok=True)
+        for partial in directory.glob("*.part"):
+            partial.unlink()
+        # Keep the files from previous runs, oldest access first
+        for path in sorted(directory.glob("*.audio"), key=lambda p: p.stat().st_atime):
+            size = path.stat().st_size
+            self.entries[path.stem] = (path, size)
+            self.size += size
+
+    def get(self, video_id):
+        entry = self.entries.get(video_id, None)
+        if entry is None:
+            return None
+        self.entries.move_to_end(video_id)
+        return entry[0]
+
+    def partialPath(self, video_id):
+        "Where to download a file before it is complete"
+        return self.directory / f"{video_id}.part"
+
+    def put(self, video_id, partial, pinned=()):
+        "Moves a completed download into the cache, evicting others to make room. Pinned ids are kept."
+        path = self.directory / f"{video_id}.audio"
+        partial.rename(path)
+        size = path.stat().st_size
+        self.entries[video_id] = (path, size)
+        self.size += size
+        self.evict(pinned)
+        return path
+
+    def evict(self, pinned):
+        for video_id in list(self.entries):
+            if self.size <= self.maxBytes:
+                break
+            if video_id in pinned:
+                continue
+            path, size = self.entries.pop(video_id)
+            path.unlink(missing_ok=True)
+            self.size -= size
+
+
+class Prefetcher:
+    """
+    Downloads the audio of the next tracks in the queue into an AudioCache.
+    Once a download is complete, the player is told to read the local file
+    instead of the remote url. Tracks that are not downloaded in time are
+    played from the remote url, as usual.
+    """
+
+    chunkSize = 64 * 1024
+
+    def __init__(self, queue, cache, count):
+        self.queue = queue
+        self.cache = cache
+        # How many tracks after the current one to download
+        self.count = count
+        # Downloads in progress by video id
+        self.downloads = {}
+        # Video ids that must not be evicted: currently playing and upcoming
+        self.pinned = set()
+        # Queued tracks (by object id) the player already reads from the cache
+        self.local = set()
+        self.session = None
+
+    def start(self):
+        self.session = aiohttp.ClientSession()
+        self.queue.addObserver(lambda state: self.schedule(state.tracks))
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+        for download in list(self.downloads.values()):
+            download.cancel()
+
+    def schedule(self, tracks):
+        if self.session is None or self.session.closed:
+            return
+        upcoming = tracks[1:1 + self.count]
+        self.pinned = {track.id for track in tracks[:1 + self.count]}
+        self.local &= {id(track) for track in tracks}
+        for track in upcoming:
+            if id(track) not in self.local and track.id not in self.downloads:
+                download = asyncio.create_task(self.prefetch(track))
+                self.downloads[track.id] = download
+                download.add_done_callback(lambda _, video_id=track.id: self.downloads.pop(video_id, None))
+
+    async def prefetch(self, track):
+        path = self.cache.get(track.id)
+        if path is None:
+            try:
+                path = await self.download(track)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as error:
+                print(f"Could not prefetch {track.id}: {error}")
+                return
+        try:
+            replaced = await self.queue.replaceTrackUri(track, path.as_uri())
+        except DBusErrorResponse as error:
+            print(f"Could not replace {track.id} with its local copy: {error}")
+            return
+        if replaced:
+            self.local.add(id(track))
+            print(f"Prefetched {track.id} at {path}")
+
+    async def download(self, track):
+        "Downloads a track into the cache. Disk writes run in the default executor."
+        loop = asyncio.get_running_loop()
+        partial = self.cache.partialPath(track.id)
+        try:
+            async with self.session.get(track.url, raise_for_status=True) as response:
+                output = await loop.run_in_executor(None, open, partial, "wb")
+                try:
+                    async for chunk in response.content.iter_chunked(Prefetcher.chunkSize):
+                        await loop.run_in_executor(None, output.write, chunk)
+                finally:
+                    await loop.run_in_executor(None, output.close)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        return self.cache.put(track.id, partial, self.pinned)
@@ -11,30 +11,55 @@ class SearchError(Exception):
 class YouTubeFinder:
     def __init__(self):
         self.query_format = "ytsearch1:{}"
+        self.video_format = "https://www.youtube.com/watch?v={}"
 
         options = {"format": "bestaudio/best", "simulate": True}
 
         self.downloader = YoutubeDL(options)
 
+        # Lists search results without extracting each video's formats
+        self.flat_downloader = YoutubeDL({"extract_flat": "in_playlist", "simulate": True})
+
+    def warmup(self):
+        "Loads the extractors used for searching, which is slow the first time"
+        for key in ("YoutubeSearch", "Youtube"):
+            self.downloader.get_info_extractor(key)
+            self.flat_downloader.get_info_extractor(key)
+
     def search(self, query):
         "Search YouTube for the first result and returns information "
         "for the highest quality, audio-only result"
+        video_id, _ = self.find(query)
+        return self.resolve(video_id)
 
-        def audioBitrate(f):
-            "Sorts by audio bitrate prioritizing audio-only results"
-            bitrate = f.get("abr", 0)
-            bitrate = 0 if bitrate is None else bitrate # Sometimes 'abr' key exists and it is null
-            isVideo = f.get("vcodec", "none") != "none"
-            return (0 if isVideo else 1, bitrate)
-
+    def find(self, query):
+        "Search YouTube for the first result and returns its video id and title, "
+        "without resolving its formats"
         query = self.query_format.format(query)
-        results = self.downloader.extract_info(query, False)
+        results = self.flat_downloader.extract_info(query, False)
         results = results.get("entries", list())
         if len(results) == 0:
             raise SearchError()
         else:
             result = results[0]
 
+        return result["id"], result.get("title", None)
+
+    def resolve(self, video_id):
+        "Returns information for the highest quality, audio-only format "
+        "of a known video, skipping the search"
+        result = self.downloader.extract_info(self.video_format.format(video_id), False)
+        return self.selectFormat(result)
+
+    @staticmethod
+    def selectFormat(result):
+        def audioBitrate(f):
+            "Sorts by audio bitrate prioritizing audio-only results"
+            bitrate = f.get("abr", 0)
+            bitrate = 0 if bitrate is None else bitrate # Sometimes 'abr' key exists and it is null
+            isVideo = f.get("vcodec", "none") != "none"
+            return (0 if isVideo else 1, bitrate)
+
         selected = max(result["formats"], key=audioBitrate)
 
         # If media is fragmented, we must use 'fragment_base_url' instead of 'url'
@@ -47,3 +72,19 @@ class YouTubeFinder:
         return Track(
             result["id"], result["title"], result["thumbnail"], result["tags"], url,
         )
+
+
+# Search engine for worker processes. Each process owns its own YouTubeFinder,
+# created once by the pool initializer, and only returns compact Track objects.
+worker_finder = None
+
+def initializeWorker():
+    global worker_finder
+    worker_finder = YouTubeFinder()
+    worker_finder.warmup()
+
+def findInWorker(query):
+    return worker_finder.find(query)
+
+def resolveInWorker(video_id):
+    return worker_finder.resolve(video_id)
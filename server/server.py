@@ -1,88 +1,214 @@
-from aiohttp import web
+from aiohttp import ClientError, WSMsgType, web
+from aiohttp.helpers import ETag
 from aiohttp.web_response import json_response
 from aiohttp.web_fileresponse import FileResponse
 from aiohttp_sse import EventSourceResponse, sse_response
 
 import asyncio
 
-from concurrent.futures import ThreadPoolExecutor
-from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import aclosing, suppress
+from copy import copy
 
-from itertools import count
 
 import json
 
+from jukebox.server import metrics
+from jukebox.server.admission import AdmissionControl, Rejected
+from jukebox.server.assets import Assets
+from jukebox.server.cache import SingleFlight, TrackCache, normalizeQuery
+from jukebox.server.prefetch import AudioCache, Prefetcher
+from jukebox.server.thumbnails import ThumbnailCache
 from jukebox.server.tracklist import Queue, QueueState, Track, TrackEncoder
-from jukebox.server.search import YouTubeFinder
+from jukebox.server.search import YouTubeFinder, initializeWorker, findInWorker, resolveInWorker
+from jukebox.server.store import TrackStore
 
 from functools import partial
 
 from pathlib import Path
 
 import jinja2
+import multiprocessing
 import os
+import time
+
+def notModified(request, etag):
+    "Whether the client already has the representation with the given (unquoted) entity tag"
+    return any(tag.value in (etag, "*") for tag in request.if_none_match or ())
 
 class Server:
     rootdir = Path(__file__).parent / ".."
     assetsdir = rootdir / "html"
     pagefile = "index.template"
+    # Most search queries accepted in a single batch
+    maxBatch = 50
+    # Most submissions in progress on a single WebSocket
+    maxSubmissions = 5
 
-    def __init__(self, host, port, queue):
+    def __init__(self, host, port, queue, searchMode="thread", searchWorkers=None, cacheDir=None,
+                 rateLimit=10, maxPending=None, prefetch=0, prefetchSize=512, develop=False, reusePort=False,
+                 finder=None):
         self.host = host
         self.port = port
+        # Share the port with other server processes
+        self.reusePort = reusePort
 
-        # Performs video searches on YouTube
-        self.finder = YouTubeFinder()
+        # Recent search results, so that repeated requests skip the search
+        self.cache = TrackCache()
+        # Searches in progress by normalized query
+        self.searches = SingleFlight()
+        # Stream url resolutions in progress by video id
+        self.resolutions = SingleFlight()
+        # Songs resolved in previous runs
+        self.store = None if cacheDir is None else TrackStore(Path(cacheDir) / "tracks.sqlite")
+        # Thumbnails of resolved songs, served to clients
+        self.thumbnails = ThumbnailCache()
 
         # List of tracks and DBus communication with media player
         self.queue = queue
 
+        # Downloads the next tracks to a local cache (prefetchSize in MiB)
+        self.prefetcher = None
+        if prefetch > 0 and cacheDir is not None:
+            audio = AudioCache(Path(cacheDir) / "audio", prefetchSize * 2**20)
+            self.prefetcher = Prefetcher(queue, audio, prefetch)
+
         # Web application server
         app = web.Application()
         app.add_routes(
             [
                 web.get("/", lambda req: self.getRoot(req)),
                 web.get("/tracks", lambda req: self.getTracks(req)),
+                web.get("/history", lambda req: self.getHistory(req)),
                 web.post("/tracks", lambda req: self.addTrack(req)),
+                web.post("/tracks/batch", lambda req: self.addTracks(req)),
                 web.delete("/tracks/{track_id}", lambda req: self.removeTrack(req)),
                 web.get("/changes", lambda req: self.notifyChange(req)),
-                web.static("/assets", Server.assetsdir),
+                web.get("/ws", lambda req: self.connectWebSocket(req)),
+                web.get("/thumbnails/{video_id}", lambda req: self.getThumbnail(req)),
+                web.get("/assets/{filename}", lambda req: self.getAsset(req)),
+                web.get("/metrics", lambda req: self.getMetrics(req)),
             ]
         )
         self.runner = web.AppRunner(app)
 
         # Will be used to process search requests in the background
-        # Make sure each worker thread has an event loop
-        self.pool = ThreadPoolExecutor(initializer=lambda:
-                asyncio.set_event_loop(asyncio.new_event_loop())
-                )
+        if searchMode == "process":
+            # Each worker process has its own YouTubeFinder, so that extractions
+            # do not contend for the GIL with each other nor with the event loop
+            self.finder = None
+            self.searchWorkers = searchWorkers or os.cpu_count()
+            self.pool = ProcessPoolExecutor(max_workers=self.searchWorkers,
+                                            mp_context=multiprocessing.get_context("forkserver"),
+                                            initializer=initializeWorker)
+            self.backgroundFind = findInWorker
+            self.backgroundResolve = resolveInWorker
+        else:
+            # Performs video searches on YouTube, unless given another finder.
+            # Shared by all worker threads.
+            self.finder = finder or YouTubeFinder()
+            # Same default as ThreadPoolExecutor
+            self.searchWorkers = searchWorkers or min(32, os.cpu_count() + 4)
+            self.pool = ThreadPoolExecutor(max_workers=self.searchWorkers)
+            self.backgroundFind = self.finder.find
+            self.backgroundResolve = self.finder.resolve
+
+        # Limits searches per client (rateLimit per minute) and the search backlog
+        self.admission = AdmissionControl(maxPending or 2 * self.searchWorkers, rate=rateLimit / 60)
+
+        # Gauges are read when metrics are requested
+        metrics.listeners.setFunction(lambda: len(self.queue.listeners))
+        metrics.searchBacklog.setFunction(lambda: self.admission.pending)
+        metrics.queueLength.setFunction(lambda: len(self.queue.tracklist))
+
+        # Scripts and stylesheets, precompressed
+        self.assets = Assets(Server.assetsdir)
 
         template_dir = ""
         self.env = jinja2.Environment(
                         loader=jinja2.FileSystemLoader(searchpath=Server.assetsdir),
                         trim_blocks=True,
                         lstrip_blocks=True)
+        self.env.globals["asset"] = lambda name: self.assets.url(name)
 
         self.template_mtime = 0
+        self.template_version = 0
         self.reload_template()
 
+        # Rendered page for the current tracklist, as (etag, body)
+        self.page = None
+        self.queue.addObserver(lambda state: self.invalidatePage())
+
+        # Tracks resolved by other worker processes are only known from the
+        # tracklist, which may already hold some
+        self.registerThumbnails(self.queue.tracklist)
+        self.queue.addObserver(lambda state: self.registerThumbnails(state.tracks))
+
+        # Only look for template changes during development
+        self.develop = develop
+        self.watcher = None
+
     def reload_template(self):
         curr_mtime = os.stat(Server.assetsdir / Server.pagefile).st_mtime
         if self.template_mtime < curr_mtime:
             self.template_mtime = curr_mtime
+            self.template_version += 1
             self.template = self.env.get_template(Server.pagefile)
+            self.invalidatePage()
+
+    def invalidatePage(self):
+        self.page = None
+
+    def registerThumbnails(self, tracks):
+        "Records where to fetch the thumbnails of queued tracks this process did not resolve"
+        for track in tracks:
+            if self.thumbnails.origins.get(track.id) is None:
+                self.thumbnails.register(track.id, track.caption)
+
+    async def watchTemplate(self):
+        "Reloads the page template and the assets it links when they are modified"
+        while True:
+            await asyncio.sleep(1)
+            if self.assets.reload():
+                # Asset urls in the page changed
+                self.template_mtime = 0
+            self.reload_template()
 
     async def start(self):
+        await self.warmup()
         await self.runner.setup()
-        site = web.TCPSite(self.runner, self.host, self.port)
+        site = web.TCPSite(self.runner, self.host, self.port, reuse_port=self.reusePort or None)
         await site.start()
+        self.thumbnails.start()
+        if self.develop:
+            self.watcher = asyncio.create_task(self.watchTemplate())
+        if self.prefetcher is not None:
+            self.prefetcher.start()
 
     async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+        if self.prefetcher is not None:
+            await self.prefetcher.stop()
         await self.queue.cleanup()
         await self.runner.cleanup()
+        await self.thumbnails.stop()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        if self.store is not None:
+            self.store.close()
+
+    async def warmup(self):
+        "Starts the search workers before the first request arrives"
+        loop = asyncio.get_running_loop()
+        if self.finder is not None:
+            await loop.run_in_executor(self.pool, self.finder.warmup)
+        else:
+            # The process pool spawns a new worker for each task submitted while
+            # the others are busy. Worker initialization does the warm up.
+            await asyncio.gather(*[loop.run_in_executor(self.pool, os.getpid)
+                                    for _ in range(self.searchWorkers)])
 
     def render(self, state):
-        self.reload_template()
         return self.template.render(current=state.get('current', None),
                                     next=state.get('next', list()),
                                     mobile=state.get('isMobile', False))
@@ -93,62 +219,353 @@ class Server:
         # if agent:
         #     isMobile = 'Mobile' in agent
 
+        # The page is a different representation of the same tracklist.
+        # It also changes when the template is reloaded.
+        etag = f"page{self.template_version}-{self.queue.etag}"
+        if notModified(request, etag):
+            return Server.notModifiedResponse(etag)
+
+        if self.page is None or self.page[0] != etag:
+            self.page = (etag, self.renderPage())
+        response = web.Response(body=self.page[1], content_type="text/html", charset="utf-8",
+                                headers={"Cache-Control": "no-cache"})
+        response.etag = etag
+        return response
+
+    def renderPage(self):
         state = QueueState(self.queue)
         result = {}
         if len(state.tracks) > 0:
             result['current'] = state.tracks[0]
         if len(state.tracks) > 1:
             result['next'] = state.tracks[1:]
-            # Set queue position
-            for pos, item in zip(count(2), result['next']):
-                item.pos = pos
 
         # state['mobile'] = isMobile
 
-        text = self.render(result)
-        return web.Response(text=text, content_type="text/html")
+        return self.render(result).encode()
 
     async def getTracks(self, request):
+        if notModified(request, self.queue.etag):
+            return Server.notModifiedResponse(ETag(self.queue.etag, is_weak=True), {"Vary": "Accept-Encoding"})
+        return self.tracksResponse()
+
+    def tracksResponse(self):
         state = QueueState(self.queue)
-        return json_response(
+        response = json_response(
             data=state.tracks,
-            headers={"ETag": state.etag},
+            headers={"Cache-Control": "no-cache", "Vary": "Accept-Encoding"},
+            dumps=lambda d: json.dumps(d, cls=TrackEncoder),
+        )
+        # Whether the body is compressed is only known once sent: the same
+        # weak entity tag stands for both codings
+        response.etag = ETag(state.etag, is_weak=True)
+        # Long queues compress well. Not worth it for short ones.
+        if len(response.body) > 1024:
+            response.enable_compression()
+        return response
+
+    async def getHistory(self, request):
+        "Recently played tracks, most recent first"
+        etag = f"history-{self.queue.etag}"
+        if notModified(request, etag):
+            return Server.notModifiedResponse(etag)
+        response = json_response(
+            data=list(reversed(self.queue.tracklist.history)),
+            headers={"Cache-Control": "no-cache"},
             dumps=lambda d: json.dumps(d, cls=TrackEncoder),
         )
+        response.etag = etag
+        return response
+
+    async def getAsset(self, request):
+        asset, fingerprinted = self.assets.get(request.match_info["filename"])
+        if asset is None:
+            raise web.HTTPNotFound()
+
+        # Fingerprinted urls change with the contents, plain ones must be revalidated
+        headers = {"Vary": "Accept-Encoding",
+                   "Cache-Control": "public, max-age=31536000, immutable" if fingerprinted else "no-cache"}
+        coding, body = asset.select(request)
+        # Strong entity tags must be different for each encoding
+        etag = f"{asset.digest}-{coding}"
+        if notModified(request, etag):
+            response = web.Response(status=304, headers=headers)
+        else:
+            if coding != "identity":
+                headers["Content-Encoding"] = coding
+            response = web.Response(body=body, content_type=asset.contentType, headers=headers)
+        response.etag = etag
+        return response
+
+    @staticmethod
+    def notModifiedResponse(etag, headers=None):
+        "Tells the client that its copy is still valid. Clients must always revalidate."
+        response = web.Response(status=304, headers={"Cache-Control": "no-cache", **(headers or {})})
+        response.etag = etag
+        return response
+
+    async def search(self, query):
+        "Finds a track for the given query, only searching in the background when not cached"
+        if (track := self.cache.get(query)) is not None:
+            return track
+
+        async def searchInBackground():
+            # Cheap lookup of the video id first. Formats are only resolved if
+            # there is no fresh stream url for that video already.
+            video_id = self.cache.videoId(query)
+            if video_id is None and self.store is not None:
+                video_id = self.store.videoId(query)
+            if video_id is None:
+                print("Run background")
+                video_id, _ = await self.runInBackground("find", self.backgroundFind, query)
+                if self.store is not None:
+                    self.store.putQuery(query, video_id)
+            self.cache.putQuery(query, video_id)
+            return await self.resolve(video_id)
+
+        # Identical queries submitted at the same time share a single search.
+        # Each caller gets its own copy, since tracks are annotated once queued.
+        track = await self.searches.run(normalizeQuery(query), searchInBackground)
+        return copy(track)
+
+    async def resolve(self, video_id):
+        """
+        Returns the track for a video id, extracting its formats only when there
+        is no fresh stream url. Concurrent resolutions of the same video share it.
+        """
+        if (track := self.cache.getById(video_id)) is not None:
+            return track
+        if self.store is not None and (track := self.store.get(video_id)) is not None:
+            self.cache.putTrack(track)
+            self.thumbnails.register(video_id, track.caption)
+            return track
+
+        async def resolveInBackground():
+            track = await self.runInBackground("resolve", self.backgroundResolve, video_id)
+            if self.store is not None:
+                self.store.putTrack(track)
+            self.cache.putTrack(track)
+            self.thumbnails.register(video_id, track.caption)
+            return track
+
+        return copy(await self.resolutions.run(video_id, resolveInBackground))
+
+    async def runInBackground(self, step, function, *args):
+        "Runs a search step in the executor, provided there is room in the search backlog"
+        self.admission.reserve()
+        start = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            started, finished, result = await loop.run_in_executor(self.pool, metrics.timedCall, function, *args)
+            metrics.searchQueueWait.labels(step).observe(started - start)
+            metrics.searchExtraction.labels(step).observe(finished - started)
+            return result
+        finally:
+            self.admission.release(time.monotonic() - start)
+
+    @staticmethod
+    def rejection(rejected):
+        "HTTP error response for a request that was not admitted"
+        errorType = web.HTTPTooManyRequests if rejected.status == 429 else web.HTTPServiceUnavailable
+        return errorType(text=rejected.reason, headers={"Retry-After": str(rejected.retryAfter)})
 
     async def addTrack(self, request):
-        def queryInBackground(self, request):
-            # This is run in a different thread
-            loop = asyncio.get_event_loop()
-            query = loop.run_until_complete(request.text())
-            if not query:
-                raise web.HTTPBadRequest(text="Illegal search query")
-            print("Run background")
-            return self.finder.search(query)
+        query = await request.text()
+        if not query:
+            raise web.HTTPBadRequest(text="Illegal search query")
 
-        loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(self.pool, queryInBackground, self, request)
+        try:
+            self.admission.admit(request.remote)
+            result = await self.search(query)
+        except Rejected as rejected:
+            raise Server.rejection(rejected)
 
         await self.queue.addTrack(result)
-        return await self.getTracks(request)
+        return self.tracksResponse()
 
-    async def removeTrack(self, request):
+    async def addTracks(self, request):
+        """
+        Queues a JSON list of search queries. Searches run concurrently and
+        their progress is streamed back as one JSON document per line.
+        Tracks are queued in submission order once all searches finish.
+        """
         try:
-            track_id = int(request.match_info['track_id'])
-            await self.queue.removeTrack(track_id)
+            queries = await request.json()
         except ValueError:
-            return web.Response(status=400, body="Invalid track id")
+            queries = None
+        if not isinstance(queries, list) or not all(isinstance(q, str) and q for q in queries):
+            raise web.HTTPBadRequest(text="Expected a list of search queries")
+        if len(queries) > Server.maxBatch:
+            raise web.HTTPRequestEntityTooLarge(Server.maxBatch, len(queries),
+                                                text=f"At most {Server.maxBatch} queries per batch")
+
+        # Every query counts against the client's rate limit
+        try:
+            self.admission.admit(request.remote, len(queries))
+        except Rejected as rejected:
+            raise Server.rejection(rejected)
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+
+        async def send(item):
+            await response.write(json.dumps(item, cls=TrackEncoder).encode() + b"\n")
+
+        # Do not let a single batch take the whole search backlog
+        slots = asyncio.Semaphore(self.searchWorkers)
+
+        async def searchItem(index, query):
+            try:
+                async with slots:
+                    return index, await self.search(query), None
+            except Exception as error:
+                return index, None, error
+
+        results = [None] * len(queries)
+        for search in asyncio.as_completed([searchItem(i, q) for i, q in enumerate(queries)]):
+            index, track, error = await search
+            results[index] = track
+            if error is None:
+                await send({"index": index, "status": "found", "track": track})
+            else:
+                await send({"index": index, "status": "error", "error": str(error) or type(error).__name__})
+
+        # The response has started: report a failure to queue as its last line
+        try:
+            await self.queue.addTracks([track for track in results if track is not None])
+        except Exception as error:
+            await send({"status": "error", "error": str(error) or type(error).__name__})
+        else:
+            await send({"status": "queued", "tracks": QueueState(self.queue).tracks})
+        await response.write_eof()
+        return response
+
+    async def getThumbnail(self, request):
+        try:
+            thumbnail = await self.thumbnails.get(request.match_info["video_id"])
+        except ClientError:
+            raise web.HTTPBadGateway(text="Could not fetch thumbnail")
+        if thumbnail is None:
+            raise web.HTTPNotFound()
+
+        # Thumbnails of a video never change
+        headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+        if notModified(request, thumbnail.etag):
+            response = web.Response(status=304, headers=headers)
+        else:
+            response = web.Response(body=thumbnail.body, content_type=thumbnail.contentType, headers=headers)
+        response.etag = thumbnail.etag
+        return response
+
+    async def getMetrics(self, request):
+        # Prometheus text exposition format. Includes the other processes'
+        # metrics when serving from several.
+        others = await self.queue.collectMetrics()
+        return web.Response(body=metrics.registry.render(others).encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+                                     "Cache-Control": "no-store"})
+
+    async def removeTrack(self, request):
+        # A position in the queue (0 is the current track), or a video id
+        track_id = request.match_info['track_id']
+        try:
+            await self.queue.removeTrack(int(track_id) if track_id.isdecimal() else track_id)
+        except KeyError:
+            return web.Response(status=404, body="No such track")
+        except ValueError as error:
+            return web.Response(status=409, body=str(error))
         return web.Response(status=200)
 
+    async def subscribe(self, lastEventId):
+        """
+        Yields tracklist change events. Starts with a snapshot of the tracklist
+        or, for clients that last saw lastEventId, the changes they missed.
+        Ends when the server is shutting down.
+        """
+        async with self.queue.createListener() as events:
+            version = -1
+            for event in self.queue.changesSince(lastEventId):
+                yield event
+                version = event.version
+            # Returns None when the server is shutting down
+            while (event := await events.get()) != None:
+                # Skip changes already included in a previous snapshot
+                if event.version > version:
+                    yield event
+                    version = event.version
+
     async def notifyChange(self, request):
         with suppress(ConnectionResetError):
-            async with sse_response(request) as response, self.queue.createListener() as events:
+            async with sse_response(request) as response, \
+                       aclosing(self.subscribe(request.headers.get("Last-Event-ID", None))) as events:
                 response.content_type = "application/json"
-                # Returns None when the server is shutting down
-                while (payload := await events.get()) != None:
-                    body = json.dumps(payload, cls=TrackEncoder)
-                    await response.send(body)
-                    events.task_done()
-                events.task_done()
+                async for event in events:
+                    # Already encoded and framed, shared with all other listeners
+                    await response.write(event.frame)
         return response
 
+    async def connectWebSocket(self, request):
+        """
+        Alternative to /changes that also takes submissions. Pushes the same
+        change events as binary frames, resuming after the event id given as
+        'since' query parameter. Accepts {"query": ...} text messages and
+        replies to each with the result of queueing it.
+        """
+        # No per-message compression: it would be paid for every client,
+        # while the event buffers are encoded once for all of them
+        ws = web.WebSocketResponse(heartbeat=30, compress=False)
+        await ws.prepare(request)
+
+        async def push():
+            async with aclosing(self.subscribe(request.query.get("since", None))) as events:
+                async for event in events:
+                    # Shared with all other listeners, no extra framing
+                    await ws.send_bytes(event.data)
+            await ws.close()
+
+        async def submit(data):
+            reply = await self.submitTrack(data, request.remote)
+            with suppress(ConnectionResetError):
+                await ws.send_str(json.dumps(reply, cls=TrackEncoder))
+
+        # Submissions run in the background, so that frames (and pongs) keep
+        # being read during searches. Replies may come in any order.
+        pusher = asyncio.create_task(push())
+        submissions = set()
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                if len(submissions) >= Server.maxSubmissions:
+                    await ws.send_str(json.dumps({"op": "result", "status": "error",
+                                                  "error": "Too many submissions in progress"}))
+                    continue
+                submission = asyncio.create_task(submit(message.data))
+                submissions.add(submission)
+                submission.add_done_callback(submissions.discard)
+        finally:
+            for task in [pusher, *submissions]:
+                task.cancel()
+            with suppress(asyncio.CancelledError, ConnectionResetError):
+                await pusher
+            await asyncio.gather(*submissions, return_exceptions=True)
+        return ws
+
+    async def submitTrack(self, message, client):
+        "Searches and queues a track submitted through a WebSocket. Returns the reply."
+        try:
+            query = json.loads(message)["query"]
+        except (ValueError, TypeError, KeyError):
+            query = None
+        if not isinstance(query, str) or not query:
+            return {"op": "result", "status": "error", "error": "Illegal search query"}
+
+        try:
+            self.admission.admit(client)
+            track = await self.search(query)
+            await self.queue.addTrack(track)
+        except Rejected as rejected:
+            return {"op": "result", "status": "error", "error": rejected.reason, "retryAfter": rejected.retryAfter}
+        except Exception as error:
+            return {"op": "result", "status": "error", "error": str(error) or type(error).__name__}
+        return {"op": "result", "status": "queued", "track": track}
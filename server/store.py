@@ -0,0 +1,73 @@
+# Persistent index of resolved tracks, kept across restarts
+import json
+import sqlite3
+import time
+
+from jukebox.server.cache import TrackCache, normalizeQuery, streamExpiry
+from jukebox.server.tracklist import Track
+
+
+class TrackStore:
+    "Maps queries to video ids, and video ids to their metadata and stream url, in a sqlite database"
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS queries (
+            query TEXT PRIMARY KEY,
+            video_id TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS videos (
+            video_id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            thumbnail TEXT,
+            tags TEXT,
+            url TEXT,
+            expires REAL
+        );
+    """
+
+    # Stream urls without an expiration date are refreshed after this time
+    ttl = 6 * 60 * 60
+
+    def __init__(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        # Lookups are done on the event loop. Keep commits cheap.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(TrackStore.schema)
+
+    def close(self):
+        self.db.close()
+
+    def videoId(self, query):
+        "Returns the video id a query resolved to, or None for unknown queries"
+        row = self.db.execute("SELECT video_id FROM queries WHERE query = ?",
+                              (normalizeQuery(query),)).fetchone()
+        return None if row is None else row[0]
+
+    def get(self, video_id):
+        "Returns the stored track for a video id, or None if unknown or its stream url expired"
+        row = self.db.execute("SELECT title, thumbnail, tags, url, expires FROM videos WHERE video_id = ?",
+                              (video_id,)).fetchone()
+        if row is None:
+            return None
+        title, thumbnail, tags, url, expires = row
+        if url is None or expires <= time.time():
+            return None
+        return Track(video_id, title, thumbnail, json.loads(tags), url)
+
+    def putQuery(self, query, video_id):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO queries VALUES (?, ?)",
+                            (normalizeQuery(query), video_id))
+
+    def putTrack(self, track):
+        expires = streamExpiry(track.url)
+        if expires is None:
+            expires = time.time() + TrackStore.ttl
+        else:
+            expires -= TrackCache.expiryMargin
+
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?)",
+                            (track.id, track.title, track.caption, json.dumps(track.tags), track.url, expires))
@@ -0,0 +1,64 @@
+# Thumbnails fetched once from their origin and served by the jukebox itself
+import aiohttp
+import hashlib
+import re
+
+from jukebox.server.cache import LRUCache, SingleFlight
+
+
+class Thumbnail:
+    def __init__(self, body, contentType):
+        self.body = body
+        self.contentType = contentType
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+
+
+class ThumbnailCache:
+    """
+    Keeps thumbnails in memory, bounded in bytes. Browsers cache them for good.
+    Only thumbnails of known tracks are served, so this is not an open proxy.
+    """
+
+    # The page shows thumbnails at most 15em wide. YouTube's high quality
+    # default thumbnail (480x360) is plenty, and much lighter than the
+    # maximum resolution one yt-dlp usually picks.
+    youtubeThumbnail = re.compile(r"^(https://i[0-9]*\.ytimg\.com)/vi(?:_webp)?/([^/]+)/[^/]+$")
+
+    def __init__(self, maxBytes=16 * 2**20):
+        # Video id to Thumbnail
+        self.thumbnails = LRUCache(maxBytes, sizeof=lambda thumbnail: len(thumbnail.body))
+        # Video id to origin url
+        self.origins = LRUCache(4096)
+        # Origin fetches in progress by video id
+        self.fetches = SingleFlight()
+        self.session = None
+
+    def start(self):
+        self.session = aiohttp.ClientSession()
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def register(self, video_id, url):
+        "Records where the thumbnail of a track can be fetched from"
+        if url:
+            match = ThumbnailCache.youtubeThumbnail.match(url)
+            if match is not None:
+                url = "{}/vi/{}/hqdefault.jpg".format(*match.groups())
+            self.origins.put(video_id, url)
+
+    async def get(self, video_id):
+        "Returns the Thumbnail of a known track, or None"
+        if (thumbnail := self.thumbnails.get(video_id)) is not None:
+            return thumbnail
+        url = self.origins.get(video_id)
+        if url is None:
+            return None
+        return await self.fetches.run(video_id, lambda: self.fetch(video_id, url))
+
+    async def fetch(self, video_id, url):
+        async with self.session.get(url, raise_for_status=True) as response:
+            thumbnail = Thumbnail(await response.read(), response.content_type)
+        self.thumbnails.put(video_id, thumbnail)
+        return thumbnail
@@ -1,19 +1,24 @@
 import asyncio
+import time
 
-from collections import deque
-from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, suppress
 from functools import partial
-from itertools import dropwhile
+from itertools import islice
 
+from jeepney import DBusErrorResponse
 from jeepney.io.asyncio import Proxy
 from jeepney.bus_messages import MatchRule, DBus, Message, MessageType, HeaderFields
 from jeepney.wrappers import Properties, MessageGenerator
 
 from jukebox.dbus.org_mpris_MediaPlayer2 import Player, TrackList
+from jukebox.dbus.properties import PropertyMirror
+from jukebox.server import metrics
+from jukebox.server.events import Channel, ChangeLog, Event
 from jukebox.dbus.signals import PropertiesChanged, TrackAdded, TrackRemoved, TrackListReplaced, Seeked
 from jukebox.server.track_metadata import TrackMetadata
 
-from json import JSONEncoder
+from json import JSONEncoder, dumps
 
 from uuid import uuid4
 
@@ -58,39 +63,263 @@ def zip_equal(iterable1, iterable2):
 
 
 class Track:
+    # Long queues keep many of these: no per-instance dict
+    __slots__ = ("id", "title", "caption", "tags", "url", "tracklist_id")
+
     def __init__(self, tid, title, caption, tags, url):
         self.id = tid
         self.title = title
         self.caption = caption
-        self.tags = tags
+        # Only needed to remember the track across restarts
+        self.tags = tuple(tags or ())
+        # Only needed for playback. Not sent to clients.
         self.url = url
         self.tracklist_id = None
 
+
+class PlayedTrack:
+    "What is remembered of a track once played: only what clients are shown"
+    __slots__ = ("id", "title", "caption", "played")
+
+    def __init__(self, track, played):
+        self.id = track.id
+        self.title = track.title
+        self.caption = track.caption
+        # When it stopped being the current track, in seconds since the epoch
+        self.played = played
+
+
 class QueueState:
     def __init__(self, queue):
         self.tracks = list(queue.tracklist)
-        self.etag = str(queue.uuid.hex)
+        self.version = queue.version
+        self.etag = queue.etag
+
+
+class Tracklist:
+    """
+    Tracks in play order, indexed by player track id and by video id.
+    Appending, advancing, and finding or removing a track by id take
+    constant time. Only positions need a walk from the head.
+    """
+
+    def __init__(self, tracks=(), historySize=50):
+        # Tracks in order. Tracks hash by identity: the same video may be queued twice.
+        self.order = OrderedDict()
+        # Recently played tracks, most recent last. Bounded, so that a long
+        # running process does not grow.
+        self.history = deque(maxlen=historySize)
+        # Track by player track id, for the tracks the player told us about
+        self.byTrackId = {}
+        # Tracks (in order) by video id
+        self.byVideoId = {}
+        self.extend(tracks)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __contains__(self, track):
+        return track in self.order
+
+    def head(self):
+        "Track being played, or None"
+        return next(iter(self.order), None)
+
+    def append(self, track):
+        self.order[track] = None
+        self.byVideoId.setdefault(track.id, {})[track] = None
+        if track.tracklist_id is not None:
+            self.byTrackId[track.tracklist_id] = track
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    def setTrackId(self, track, trackId):
+        "Records the player track id of a queued track"
+        if self.byTrackId.get(track.tracklist_id, None) is track:
+            del self.byTrackId[track.tracklist_id]
+        track.tracklist_id = trackId
+        if trackId is not None and track in self.order:
+            self.byTrackId[trackId] = track
+
+    def find(self, trackId):
+        "Track with the given player track id, or None"
+        return self.byTrackId.get(trackId, None)
+
+    def findVideo(self, video_id):
+        "First queued track of a video, or None"
+        return next(iter(self.byVideoId.get(video_id, ())), None)
+
+    def at(self, position):
+        "Track at a position, or None"
+        if position < 0:
+            return None
+        return next(islice(self.order, position, None), None)
+
+    def position(self, track):
+        return next(i for i, t in enumerate(self.order) if t is track)
+
+    def remove(self, track):
+        del self.order[track]
+        videos = self.byVideoId[track.id]
+        del videos[track]
+        if not videos:
+            del self.byVideoId[track.id]
+        if self.byTrackId.get(track.tracklist_id, None) is track:
+            del self.byTrackId[track.tracklist_id]
+
+    def advance(self, count, played):
+        """
+        Removes the first 'count' tracks, played or skipped by the player at
+        time 'played'. They go to the history. Returns them.
+        """
+        removed = list(islice(self.order, count))
+        for track in removed:
+            self.remove(track)
+            self.history.append(PlayedTrack(track, played))
+        return removed
+
+    def advanceTo(self, track, played):
+        "Advances until the given track is the head. Returns how many were removed."
+        count = 0
+        while self.order and self.head() is not track:
+            self.advance(1, played)
+            count += 1
+        return count
+
+    def clear(self):
+        "Removes all tracks. Unlike advance, does not touch the history."
+        self.reset(())
+
+    def reset(self, tracks, history=None):
+        "Replaces the tracks and, if given, the history, e.g. with a snapshot"
+        if history is not None:
+            self.history.clear()
+            self.history.extend(history)
+        self.order.clear()
+        self.byTrackId.clear()
+        self.byVideoId.clear()
+        self.extend(tracks)
+
+
+class Publisher:
+    """
+    Versioned tracklist that publishes its changes to listeners (clients
+    streaming changes) and observers (callbacks within the server)
+    """
+
+    def __init__(self, epoch):
+        # Identifies the tracklist contents: changes on restart and on every modification
+        self.epoch = epoch
+        self.version = 0
+
+        # List of tracks in media player
+        self.tracklist = Tracklist()
 
+        # Clients subscribed to song change events
+        self.listeners = set()
+        # Recent changes, for clients that reconnect
+        self.changes = ChangeLog(self.epoch)
+        # Snapshot event of the current version, built on demand
+        self.snapshot = None
+        # Callbacks invoked synchronously on every change
+        self.observers = []
+
+    @property
+    def etag(self):
+        "Entity tag of the tracklist. Cheap to compute: does not look at the tracks."
+        return f"{self.epoch}-{self.version}"
+
+    async def collectMetrics(self):
+        "Metrics of the other processes serving this tracklist, as collected by metrics.registry.collect()"
+        return []
+
+    def addObserver(self, callback):
+        "Registers a function called with the new QueueState whenever the tracklist changes"
+        self.observers.append(callback)
+
+    def notifyListChange(self, state :QueueState, change):
+        """
+        Publishes a change that took the tracklist to the given state.
+        Must be called with the tracklist lock held, so that changes are
+        published in version order.
+        """
+        # Notify subscribers with the change. Encode it only once for all of them.
+        print("Put in listeners: {}".format([t.title for t in self.tracklist]))
+        change = dict(change, etag=state.etag)
+        event = Event(self.epoch, state.version, dumps(change, cls=TrackEncoder, separators=(",", ":")).encode())
+        self.publish(state, event)
+
+    def publish(self, state :QueueState, event :Event):
+        "Hands an already encoded change to observers and listeners"
+        with metrics.fanout.time():
+            for observer in self.observers:
+                observer(state)
+            self.changes.append(event)
+            for client in self.listeners:
+                client.put(event)
+
+    def changesSince(self, event_id):
+        """
+        Returns the events a subscriber that last saw 'event_id' missed, or
+        a snapshot of the tracklist if they are not available
+        """
+        missed = self.changes.since(event_id, self.version)
+        if missed is not None:
+            return missed
+        if self.snapshot is None or self.snapshot.version != self.version:
+            state = QueueState(self)
+            # Processes mirroring the tracklist also take its history from snapshots
+            data = dumps({"op": "snapshot", "etag": state.etag, "tracks": state.tracks,
+                          "history": list(self.tracklist.history)},
+                         cls=TrackEncoder, separators=(",", ":"))
+            self.snapshot = Event(self.epoch, state.version, data.encode())
+        return [self.snapshot]
 
-class Queue:
+    @asynccontextmanager
+    async def createListener(self):
+        "Subscribes to tracklist changes. Slow subscribers get the latest snapshot instead of a backlog."
+        channel = Channel(lambda: self.changesSince(None)[0])
+        self.listeners.add(channel)
+        try:
+            yield channel
+        finally:
+            self.listeners.discard(channel)
+
+    async def closeListeners(self, deadline):
+        "Gives listeners some time to send their pending events, then disconnects them"
+        for channel in self.listeners:
+            channel.close()
+        if self.listeners:
+            _, stalled = await asyncio.wait([asyncio.create_task(channel.drained.wait())
+                                             for channel in self.listeners], timeout=deadline)
+            for waiter in stalled:
+                waiter.cancel()
+        self.listeners = set()
+
+
+class Queue(Publisher):
     def __init__(self, router, busName):
-        self.uuid = uuid4()
+        super().__init__(uuid4().hex)
 
         assert isinstance(busName, str)
         self.bus = busName
         self.router = router
 
-        # Map of tracks by player trackid
-        self.tracks = {}
-        # List of tracks in media player
         self.tracklist_lock = asyncio.Lock()
-        self.tracklist = []
         self.playing = -1
         # List of tracks pending to add to queue
         self.pending = deque()
+        # Tracks sent to the player and not matched with their player track id
+        # yet, by url. Ids are taken from the TrackAdded signals.
+        self.unassigned = {}
+        # Player and tracklist properties, as last signaled
+        self.properties = PropertyMirror(router, busName, [Player(), TrackList()])
 
-        # Clients subscribed to song change events
-        self.listeners = set()
         # Event handlers
         self.handlers = asyncio.create_task(self.registerHandler())
 
@@ -100,79 +329,197 @@ class Queue:
         the object's router
         """
         generator.bus_name = self.bus
+        if isinstance(generator, Properties):
+            # Properties are read from the address it was built with
+            generator.props_if.bus_name = self.bus
         return Proxy(generator, self.router)
 
-    async def notifyListChange(self, state :QueueState):
-        # Notify subscribers with new tracklist
-        print("Put in listeners: {}".format([t.title for t in self.tracklist]))
-        await asyncio.gather(*[client.put(state) for client in self.listeners])
-
     async def addTrack(self, track):
-        async with self.tracklist_lock:
-            # Regenerate etag
-            self.uuid = uuid4()
-            self.tracklist.append(track)
-
-            # Check if player is stopped. Resume playing if necessary
-            properties = self.instanceProxy(Properties(Player()))
-            response = await properties.get("PlaybackStatus")
-            signature, status = response[0]
-
-            tracklist = self.instanceProxy(TrackList())
-            trackIdTail = "/org/mpris/MediaPlayer2/TrackList/Append"
-            resume = (signature, status) == ("s", "Stopped")
-            await tracklist.AddTrack(track.url, trackIdTail, resume)
-
-            # Read tracklist again to match player's track id with our tracklist
-            # TODO: would be a good idea to wait for PropertiesChanged signal.
-            # Must make sure we guarantee the order of track additions such
-            # that appending two tracks concurrently returns the right result.
-            properties = self.instanceProxy(Properties(TrackList()))
-            response = await properties.get("Tracks")
-            signature, tracks = response[0]
-            print("Tracklist is now: {}".format(repr(tracks)))
-
-            track.tracklist_id = tracks[-1]
-            state = QueueState(self)
-        print("Send notification change!")
-        await self.notifyListChange(state)
+        await self.addTracks([track])
 
-    async def removeTrack(self, index):
-        print("Remove track: {}".format(index))
-        if index == 0 and len(self.tracklist) > 0:
-            async with self.tracklist_lock:
-                # Regenerate etag
-                self.uuid = uuid4()
-
-                self.trackslist = self.tracks[1:]
+    async def addTracks(self, tracks):
+        """
+        Appends tracks to the player's tracklist in the given order.
+        Subscribers are notified once for all of them, before the player is
+        told. The lock is only held for that and to send the calls, which
+        are not waited for one by one. Tracks are dropped again if the player
+        fails to add them.
+        """
+        if not tracks:
+            return
 
+        async with self.tracklist_lock:
+            # Resume playing if player is stopped. Only the first track starts playing.
+            resume = self.properties.get(Player.interface, "PlaybackStatus") == "Stopped"
+            if resume:
+                self.properties.assume(Player.interface, "PlaybackStatus", "Playing")
+            for track in tracks:
+                self.unassigned.setdefault(track.url, deque()).append(track)
+
+            self.version += 1
+            self.tracklist.extend(tracks)
+            self.notifyListChange(QueueState(self), {"op": "append", "tracks": tracks})
+
+            # One AddTrack call per track, back to back. Tasks start in the
+            # order they are created and the connection sends in the order it
+            # is asked to, so the player appends them in the tracklist's order.
+            calls = [asyncio.create_task(self.callAddTrack(track, resume and i == 0))
+                     for i, track in enumerate(tracks)]
+            submission = asyncio.create_task(self.submit(tracks, calls))
+        # The player is told even if the caller goes away
+        await asyncio.shield(submission)
+
+    async def callAddTrack(self, track, resume):
+        tracklist = self.instanceProxy(TrackList())
+        with metrics.dbusCall.labels("AddTrack").time():
+            await tracklist.AddTrack(track.url, "/org/mpris/MediaPlayer2/TrackList/Append", resume)
+
+    async def submit(self, tracks, calls):
+        "Waits for the replies to the AddTrack calls of some tracks"
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        failed = [track for track, result in zip(tracks, results) if isinstance(result, Exception)]
+        if failed:
+            await self.discard(failed)
+            raise next(result for result in results if isinstance(result, Exception))
+
+        # Players signal TrackAdded before replying. Should a signal be missed,
+        # look for the tracks in the player's tracklist by url.
+        if any(track.tracklist_id is None for track in tracks):
+            await self.findTrackIds()
+
+    async def findTrackIds(self):
+        "Matches the player's tracks we don't know the id of with the tracks waiting for one"
+        with metrics.dbusCall.labels("Get Tracks").time():
+            trackIds = await self.properties.fetch(TrackList.interface, "Tracks")
+        unknown = [trackId for trackId in trackIds if self.tracklist.find(trackId) is None]
+        if not unknown:
+            return
+        tracklist = self.instanceProxy(TrackList())
+        with metrics.dbusCall.labels("GetTracksMetadata").time():
+            metadata, = await tracklist.GetTracksMetadata(unknown)
+        for added in map(TrackMetadata.fromMPRISMetadata, metadata):
+            if (waiting := self.unassigned.get(added.uri, None)):
+                self.assignTrackId(waiting[0], added.tracklist_id, added.uri)
+
+    def assignTrackId(self, track, trackId, url):
+        "Records the player track id of a track that was waiting for it under the given url"
+        self.tracklist.setTrackId(track, trackId)
+        waiting = self.unassigned.get(url, ())
+        if track in waiting:
+            waiting.remove(track)
+            if not waiting:
+                del self.unassigned[url]
+
+    def handleTrackAdded(self, signalMessage):
+        "Matches a track added to the player with the first track sent with the same url"
+        metadata, after = signalMessage.body
+        added = TrackMetadata.fromMPRISMetadata(metadata)
+        if (waiting := self.unassigned.get(added.uri, None)):
+            self.assignTrackId(waiting[0], added.tracklist_id, added.uri)
+
+    async def discard(self, tracks):
+        "Removes tracks the player could not add"
+        async with self.tracklist_lock:
+            for track in tracks:
+                self.assignTrackId(track, None, track.url)
+                if track in self.tracklist:
+                    self.version += 1
+                    position = self.tracklist.position(track)
+                    self.tracklist.remove(track)
+                    self.notifyListChange(QueueState(self), {"op": "remove", "position": position})
+
+        # The call that was assumed to resume playing may be one that failed.
+        # The player would then stay stopped without signaling it.
+        with metrics.dbusCall.labels("Get PlaybackStatus").time():
+            await self.properties.fetch(Player.interface, "PlaybackStatus")
+
+    async def replaceTrackUri(self, track, uri):
+        """
+        Makes the player read a queued track from a different uri, e.g. a local copy.
+        The track is re-added right after its predecessor and the old entry removed.
+        Returns whether the track was replaced: the track being played can't be.
+        Like addTracks, the lock is not held during the calls. The new entry's
+        id is taken from its TrackAdded signal.
+        """
+        async with self.tracklist_lock:
+            if track not in self.tracklist or track is self.tracklist.head() or track.tracklist_id is None:
+                return False
+            previous = self.tracklist.at(self.tracklist.position(track) - 1).tracklist_id
+            if previous is None:
+                return False
+            replaced = track.tracklist_id
+            self.unassigned.setdefault(uri, deque()).append(track)
+
+        tracklist = self.instanceProxy(TrackList())
+        try:
+            # The new entry goes right before the old one, so that the player
+            # plays the local copy should it get there in the meantime
+            with metrics.dbusCall.labels("AddTrack").time():
+                await tracklist.AddTrack(uri, previous, False)
+        except BaseException:
+            # No longer waiting for an id under the new uri
+            self.assignTrackId(track, track.tracklist_id, uri)
+            raise
+        if track.tracklist_id == replaced:
+            await self.findTrackIds()
+
+        # A removal in progress holds the lock until the track is out of the list
+        async with self.tracklist_lock:
+            removed = track not in self.tracklist
+        if not removed:
+            with metrics.dbusCall.labels("RemoveTrack").time():
+                await tracklist.RemoveTrack(replaced)
+            return True
+        # The track was removed meanwhile, through one of its entries. Remove the other.
+        for trackId in {replaced, track.tracklist_id} - {None}:
+            with suppress(DBusErrorResponse), metrics.dbusCall.labels("RemoveTrack").time():
+                await tracklist.RemoveTrack(trackId)
+        return False
+
+    async def removeTrack(self, key):
+        """
+        Removes a track from the queue: the one at a position (int), or the
+        next one of a video (str). Removing the current track skips to the
+        next. Raises KeyError if there is no such track.
+        """
+        print("Remove track: {}".format(key))
+        async with self.tracklist_lock:
+            track = self.tracklist.at(key) if isinstance(key, int) else self.tracklist.findVideo(key)
+            if track is None:
+                raise KeyError(key)
+
+            if track is self.tracklist.head():
+                # Skipping is advancing, once the player did skip. Its song
+                # change signal is handled after the lock is released, finds
+                # the new current track already at the head and does not
+                # advance again.
                 player = self.instanceProxy(Player())
                 await player.Next()
 
-                state = QueueState(self)
-            await self.notifyListChange(state)
-        else:
-            raise ValueError("Can only remove the first track in the list")
-
-    @asynccontextmanager
-    async def createListener(self):
-        eventQueue = asyncio.Queue()
-        self.listeners.add(eventQueue)
-        try:
-            yield eventQueue
-        finally:
-            self.listeners.remove(eventQueue)
-
-    async def cleanup(self):
+                self.version += 1
+                played = time.time()
+                self.tracklist.advance(1, played)
+                self.notifyListChange(QueueState(self), {"op": "advance", "count": 1, "played": played})
+            else:
+                if track.tracklist_id is None:
+                    raise ValueError("The track is still being added to the player")
+                tracklist = self.instanceProxy(TrackList())
+                await tracklist.RemoveTrack(track.tracklist_id)
+
+                self.version += 1
+                position = self.tracklist.position(track)
+                self.tracklist.remove(track)
+                self.notifyListChange(QueueState(self), {"op": "remove", "position": position})
+
+    async def cleanup(self, deadline=2.0):
+        "Stops handling player signals. Gives listeners some time to send their pending events."
         self.handlers.cancel("Cleanup")
-        await asyncio.gather(*[t for queue in self.listeners
-                                    for t in [queue.put(None), queue.join()]])
+        await self.closeListeners(deadline)
         self.tasks = []
-        self.listeners = set()
 
     async def registerHandler(self):
-        async def eventHandler(rule, subscribedFuture, callback):
-            with self.router.filter(rule, bufsize=10) as handler:
+        async def eventHandler(rule, subscribedFuture, callback, bufsize):
+            with self.router.filter(rule, bufsize=bufsize) as handler:
                 # We need to send this to the session dbus
                 subscribed = await Proxy(DBus(), self.router).AddMatch(rule) == ()
                 if subscribed:
@@ -182,21 +529,33 @@ class Queue:
                             RuntimeError("Could not register matching rule"))
                 while True:
                     value = await handler.get()
+                    metrics.signals.labels(value.header.fields.get(HeaderFields.member, "")).inc()
                     callback(value)
 
-        def handleEvent(rule, callback):
+        def handleEvent(rule, callback, bufsize=10):
             loop = asyncio.get_running_loop()
             subscribed = loop.create_future()
-            loop.create_task(eventHandler(rule, subscribed, callback))
+            loop.create_task(eventHandler(rule, subscribed, callback, bufsize))
             return subscribed
 
         allSubscribed = []
+        # Signals carry the player's unique connection name as sender, not
+        # the well-known name. Filter by the former, or none would match.
+        owner, = await Proxy(DBus(), self.router).GetNameOwner(self.bus)
+
         # Subscribe to /org/mpris/MediaPlayer2/Metadata property changes,
         # which mean the song has changed
-        rule = PropertiesChanged(sender=self.bus)
+        # The property mirror must see every change: do not drop any.
+        rule = PropertiesChanged(sender=owner)
         # rule.add_arg_condition(0, Player().interface, "string")
         allSubscribed.append(
-                handleEvent(rule, self.handlePlayerPropertiesChanged))
+                handleEvent(rule, self.handlePlayerPropertiesChanged, bufsize=0))
+
+        # Subscribe to TrackAdded signal, which tells the player track id
+        # of the tracks we add
+        rule = TrackAdded(sender=owner)
+        allSubscribed.append(
+                handleEvent(rule, self.handleTrackAdded, bufsize=256))
 
         # Subscribe to TrackListReplaced signal
         # which mean a song was added or removed
@@ -220,6 +579,9 @@ class Queue:
         await asyncio.gather(*allSubscribed)
         print("DBus signals subscribed")
 
+        # From now on, property changes are signaled
+        await self.properties.sync()
+
     def handlePlayerPropertiesChanged(self, signalMessage):
         """
         Check if the current song's metadata property changed.
@@ -232,9 +594,13 @@ class Queue:
         assert signalMessage.header.fields[HeaderFields.signature] == 'sa{sv}as'
 
         interface, changed, invalidated = signalMessage.body
-        # We expect the properties to always be located in 'changed' map,
-        # not in the 'invalidated' list.
-        assert all(i not in invalidated for i in ['PlaybackStatus', 'Metadata', 'CanGoNext'])
+        self.properties.update(signalMessage)
+        if interface != Player.interface:
+            return
+        # Properties may be invalidated instead of changed. Read the current
+        # song again in that case.
+        if "Metadata" in invalidated:
+            asyncio.create_task(self.handleMetadataInvalidated())
 
         if (variant := changed.get("PlaybackStatus",None)) is not None \
            and variant == ('s', 'Stopped'):
@@ -256,42 +622,58 @@ class Queue:
             pass
 
 
+    async def handleMetadataInvalidated(self):
+        metadata = await self.properties.fetch(Player.interface, "Metadata")
+        await self.handleSongChanged(metadata)
+
     async def handleSongChanged(self, metadata):
         # Network streams have unknown length until they start buffering
         # There might be multiple PropertiesChanged signal for the same
         # song, therefore a song only changes if the uri does not match with
         # the first song in the queue
 
-        state = None
         async with self.tracklist_lock:
             # Metadata is None when there isn't any more songs to play
             if not metadata:
-                self.tracklist = []
-                self.tracks = {}
+                if not self.tracklist:
+                    return
+                self.version += 1
+                played = time.time()
+                advanced = len(self.tracklist.advance(len(self.tracklist), played))
                 self.pending = deque()
-                state = QueueState(self)
+                self.notifyListChange(QueueState(self), {"op": "advance", "count": advanced, "played": played})
             else:
                 track = TrackMetadata.fromMPRISMetadata(metadata)
-                songChanged = not self.tracklist or self.tracklist[0].tracklist_id != track.tracklist_id
-                if songChanged:
+                current = self.tracklist.find(track.tracklist_id)
+                if current is None and (waiting := self.unassigned.get(track.uri, None)):
+                    # Its player track id is not known yet. Recognize it by url.
+                    current = waiting[0]
+                    self.assignTrackId(current, track.tracklist_id, track.uri)
+
+                if self.tracklist and current is not self.tracklist.head():
                     print("Handle song changed. Current: {}; List: {}".format(
                                     track.tracklist_id,
                                     [t.tracklist_id for t in self.tracklist]))
-                    # Remove all elements from queue until the current
-                    mismatchCurrent = lambda t: t.tracklist_id != track.tracklist_id
-
-                    self.tracklist = list(dropwhile(mismatchCurrent, self.tracklist))
-                    state = QueueState(self)
+                    # Remove all elements from queue until the current.
+                    # Everything, if the current one is not ours.
+                    self.version += 1
+                    played = time.time()
+                    if current in self.tracklist:
+                        advanced = self.tracklist.advanceTo(current, played)
+                    else:
+                        advanced = len(self.tracklist.advance(len(self.tracklist), played))
 
-        if state:
-            # Notify clients of song changed event
-            await self.notifyListChange(state)
+                    # Notify clients of song changed event. Workers record the
+                    # tracks as played at the same time.
+                    self.notifyListChange(QueueState(self), {"op": "advance", "count": advanced, "played": played})
 
 
 class TrackEncoder(JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Track):
             return {"id": obj.id, "title": obj.title, "caption": obj.caption}
+        if isinstance(obj, PlayedTrack):
+            return {"id": obj.id, "title": obj.title, "caption": obj.caption, "played": obj.played}
         if isinstance(obj, QueueState):
             return {"etag": str(obj.etag), "tracks": obj.tracks}
         return super().default(obj)